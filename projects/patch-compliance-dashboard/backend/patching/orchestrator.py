@@ -12,24 +12,1251 @@ import asyncio
 import re
 import time
 import base64
-from typing import Dict, List, Any, Optional
-from datetime import datetime
+import gzip
+import bisect
+import functools
+import hashlib
+import heapq
+import itertools
+import os
+import shlex
+import sqlite3
+import tempfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from itertools import islice
+from pathlib import Path
+from urllib.parse import urlsplit
+from typing import Dict, List, Any, Optional, Callable, Awaitable
+from datetime import datetime, timedelta
 from enum import Enum
 
+# Playbooks shipped with the dashboard (deployed to the Ansible VM)
+PLAYBOOK_DIR = Path(__file__).resolve().parents[2] / "ansible-playbooks"
+
+# Job database, spilled output, ... (override with PATCHING_DATA_DIR)
+DEFAULT_DATA_DIR = Path(__file__).resolve().parents[1] / "data" / "patching"
+
 class PatchJobStatus(Enum):
     PENDING = "pending"
     RUNNING = "running"
     COMPLETED = "completed"
     FAILED = "failed"
     RETRYING = "retrying"
+    SCHEDULED = "scheduled"
+    CANCELLED = "cancelled"
 
 class ErrorCategory(Enum):
     NETWORK = "network"
     PERMISSION = "permission"
     PACKAGE = "package"
+    LOCK = "lock"  # dpkg/apt lock held by another process
     TIMEOUT = "timeout"
     UNKNOWN = "unknown"
 
+class ErrorClassifier:
+    """Rule-based error categorisation, compiled once
+    
+    Rules are (category, pattern) pairs in priority order, matched against
+    lowercased text (write patterns in lowercase; re.MULTILINE is on).
+    classify_all() joins every target's error text into one string and
+    runs each rule once over it, highest priority first, dropping targets
+    as soon as a rule claims them. One alternation of all rules would be a
+    single scan, but CPython's re can't use its literal-prefix search on
+    it and ends up several times slower (see benchmark_classifier()).
+    """
+    
+    DEFAULT_RULES = [
+        # Ansible prefixes every ssh-level UNREACHABLE with "Failed to connect
+        # to the host via ssh:"; an auth failure in there is still permission
+        ("permission", r"permission denied|unauthori[sz]ed|forbidden|access denied|not permitted|authentication fail"),
+        # Failing to establish a connection is a network error even when it's
+        # phrased as a timeout; the timeout rule would claim it otherwise
+        ("network", r"ssh: connect to host|connection timed out"),
+        ("timeout", r"timed?[ -]?out|timeout|expected time frame"),
+        ("lock", r"could not get lock|unable to acquire the dpkg|dpkg frontend lock|lock-frontend"),
+        ("network", r"unreachable|connection (?:refused|reset|closed)|could not resolve|name or service not known"
+                    r"|no route to host|temporary failure resolving|failed to connect"),
+        ("package", r"dpkg|unmet dependenc|broken packages|held broken|\bapt(?:-get)?\b|^e: |sub-process .* returned an error"),
+    ]
+    
+    def __init__(self, rules: Optional[List[Any]] = None):
+        self.rules = []
+        for rule in rules or self.DEFAULT_RULES:
+            category, pattern = (rule["category"], rule["pattern"]) if isinstance(rule, dict) else rule
+            self.rules.append((ErrorCategory(category), re.compile(pattern, re.MULTILINE)))
+    
+    def classify(self, text: str) -> ErrorCategory:
+        return self.classify_all({"": text})[""]
+    
+    def classify_all(self, texts: Dict[str, str]) -> Dict[str, ErrorCategory]:
+        """Categorise several targets' error texts together"""
+        categories = {}
+        remaining = {name: (text or "").lower() for name, text in texts.items()}
+        for category, pattern in self.rules:
+            if not remaining:
+                break
+            names = list(remaining)
+            offsets = []
+            position = 0
+            for name in names:
+                offsets.append(position)
+                position += len(remaining[name]) + 1
+            # Newline-separated: without DOTALL no "." can match across two texts
+            combined = "\n".join(remaining.values())
+            for match in pattern.finditer(combined):
+                name = names[bisect.bisect_right(offsets, match.start()) - 1]
+                if name in remaining:
+                    categories[name] = category
+                    del remaining[name]
+        for name in remaining:
+            categories[name] = ErrorCategory.UNKNOWN
+        return {name: categories[name] for name in texts}
+
+class AnsibleOutputParser:
+    """Incremental parser for ansible-playbook JSONL callback events
+    
+    Playbooks run with the ansible.posix.jsonl stdout callback, which prints
+    one JSON event per line. Events are fed one line at a time while the
+    playbook is still running and per-target results are built in a single
+    pass: current task, completed task count, per-target state and stats,
+    failure messages and package counts. Only a bounded, human-readable tail
+    of the run is kept.
+    """
+    
+    # Tasks whose stdout is a probe JSON document (see the playbooks' probe_script)
+    PROBE_TASKS = {"Probe containers", "Probe packages"}
+    # Download-only task; stdout is {"staged_bytes": ..., "cache_bytes": ...}
+    PREFETCH_TASKS = {"Prefetch packages"}
+    # Upgrade task -> fields holding the number and names of packages it upgrades
+    UPGRADE_TASKS = {
+        "Upgrade packages (security only)": ("security_updates", "security_packages"),
+        "Upgrade all packages": ("packages_available", "packages")
+    }
+    
+    def __init__(self, targets: List[str], tasks_total: int = 0, tail_lines: int = 2000):
+        self.tasks_total = tasks_total
+        self.tasks_completed = 0
+        self.tasks_seen = set()
+        self.current_task = None
+        self.started_at = time.time()
+        self.targets = {
+            target: {
+                "state": "running",
+                "task": None,
+                "packages_available": 0,
+                "packages_upgraded": 0,
+                "security_updates": 0,
+                "packages": [],
+                "security_packages": [],
+                "upgraded_packages": [],
+                "reboot_required": False,
+                "fingerprint": None,
+                "probed": False,  # a probe document was parsed for this target
+                "seen": False,  # the playbook reported on this target at all
+                "staged_bytes": None,
+                "cache_bytes": None,
+                "error": None,
+                "stats": {"ok": 0, "changed": 0, "failures": 0, "unreachable": 0, "skipped": 0},
+                "lines": deque(maxlen=20)  # this target's own recent output
+            }
+            for target in targets
+        }
+        self.stats_received = False
+        self.tail = deque(maxlen=tail_lines)
+        self.fresh = []  # tail lines the caller hasn't picked up yet
+        self.dirty = set()  # targets changed since the caller last looked
+    
+    def _log(self, line: str):
+        self.tail.append(line)
+        self.fresh.append(line)
+    
+    def feed(self, line: str):
+        """Consume one line of playbook output"""
+        if not line.startswith("{"):
+            if line.strip():
+                self._log(line)
+            return
+        try:
+            event = json.loads(line)
+        except ValueError:
+            self._log(line)
+            return
+        
+        name = event.get("_event", "")
+        if name in ("v2_playbook_on_task_start", "v2_playbook_on_handler_task_start"):
+            task = event.get("task", {})
+            # The free strategy announces a task once per host; count it once
+            task_id = task.get("id") or task.get("name")
+            if task_id in self.tasks_seen:
+                return
+            self.tasks_seen.add(task_id)
+            if self.current_task is not None:
+                self.tasks_completed += 1
+            self.current_task = task.get("name")
+            self._log(f"TASK [{self.current_task}]")
+        elif name.startswith("v2_runner_on_"):
+            status = name[len("v2_runner_on_"):]
+            task_name = event.get("task", {}).get("name")
+            for host, result in event.get("hosts", {}).items():
+                self._record_result(status, task_name, host, result)
+        elif name == "v2_playbook_on_stats":
+            self._record_stats(event.get("stats", {}))
+    
+    def _record_result(self, status: str, task_name: str, host: str, result: Dict[str, Any]):
+        if host in self.targets:
+            self._apply(host, self._status_of(result, status), task_name, result)
+    
+    @staticmethod
+    def _status_of(result: Dict[str, Any], status: str) -> str:
+        if status == "unreachable" or result.get("unreachable"):
+            return "unreachable"
+        if status == "failed" or result.get("failed"):
+            return "failed"
+        if status == "skipped" or result.get("skipped"):
+            return "skipped"
+        return "changed" if result.get("changed") else "ok"
+    
+    def _apply(self, target: str, status: str, task_name: str, result: Dict[str, Any]):
+        data = self.targets[target]
+        data["seen"] = True
+        data["task"] = task_name
+        if task_name in self.PROBE_TASKS and status in ("ok", "changed"):
+            status = self._apply_probe(data, result)
+        data["stats"]["failures" if status == "failed" else status] += 1
+        
+        if status in ("failed", "unreachable"):
+            data["state"] = status
+            # shell failures only say "non-zero return code"; stderr has the detail
+            data["error"] = (result.get("stderr") or result.get("msg") or "Execution failed").strip()
+            line = f"{status}: [{target}] => {data['error']}"
+        else:
+            line = f"{status}: [{target}]"
+            if task_name in self.UPGRADE_TASKS and status == "changed":
+                count_field, names_field = self.UPGRADE_TASKS[task_name]
+                data["packages_upgraded"] = data[count_field]
+                data["upgraded_packages"] = list(data[names_field])
+            elif task_name in self.PREFETCH_TASKS and status != "skipped":
+                try:
+                    staged = json.loads(result.get("stdout") or "")
+                except ValueError:
+                    staged = {}
+                data["staged_bytes"] = staged.get("staged_bytes")
+                data["cache_bytes"] = staged.get("cache_bytes")
+        self._log(line)
+        data["lines"].append(f"TASK [{task_name}] {line}")
+        self.dirty.add(target)
+    
+    @staticmethod
+    def _apply_probe(data: Dict[str, Any], result: Dict[str, Any]) -> str:
+        """Take counts and the package list from a probe document; a probe that
+        didn't produce one (ssh/pct failure) fails the target"""
+        try:
+            probe = json.loads(result.get("stdout") or "")
+        except ValueError:
+            probe = None
+        if result.get("rc", 0) != 0 or not isinstance(probe, dict):
+            result.setdefault("msg", f"probe exited with {result.get('rc')}")
+            return "failed"
+        data["packages_available"] = probe.get("total", 0)
+        data["security_updates"] = probe.get("security", 0)
+        data["packages"] = [package["name"] for package in probe.get("packages", [])]
+        # Security by origin of the candidate version, as the playbook determined it
+        data["security_packages"] = [package["name"] for package in probe.get("packages", []) if package.get("security")]
+        data["reboot_required"] = bool(probe.get("reboot_required"))
+        data["fingerprint"] = probe.get("fingerprint")
+        data["probed"] = True
+        return "ok"
+    
+    def _record_stats(self, stats: Dict[str, Dict[str, int]]):
+        self.stats_received = True
+        self._log("PLAY RECAP")
+        for host, host_stats in stats.items():
+            self._log(f"{host} : " + " ".join(f"{key}={value}" for key, value in sorted(host_stats.items())))
+            if host not in self.targets:
+                continue
+            data = self.targets[host]
+            data["seen"] = True
+            data["stats"] = dict(host_stats)
+            if host_stats.get("unreachable"):
+                data["state"] = "unreachable"
+            elif host_stats.get("failures"):
+                data["state"] = "failed"
+            if data["state"] in ("failed", "unreachable"):
+                data["error"] = data["error"] or "Execution failed"
+            self.dirty.add(host)
+    
+    def finish(self, returncode: int, stderr: str = ""):
+        """Settle every target once the playbook has exited
+        
+        A target the playbook never reported on (no task result, no recap
+        entry) was not run, whatever the exit code says.
+        """
+        if self.current_task is not None:
+            self.tasks_completed += 1
+            self.current_task = None
+        for name, data in self.targets.items():
+            if data["state"] == "running":
+                if returncode != 0 and not self.stats_received:
+                    # Playbook never got going (syntax error, missing file, ...)
+                    data["state"] = "failed"
+                    data["error"] = stderr.strip()[-500:] or f"ansible-playbook exited with {returncode}"
+                elif not data["seen"]:
+                    data["state"] = "failed"
+                    data["error"] = "Not run by the playbook" + (f" (exit code {returncode})" if returncode else "")
+                else:
+                    data["state"] = "completed"
+            self.dirty.add(name)
+    
+    def eta(self) -> Optional[float]:
+        """Seconds remaining, extrapolated from the pace of completed tasks"""
+        if not self.tasks_completed or not self.tasks_total:
+            return None
+        remaining = max(self.tasks_total - self.tasks_completed, 0)
+        return round((time.time() - self.started_at) / self.tasks_completed * remaining, 1)
+
+class AssetIndex:
+    """Lookup index over the discovery cache, keyed by name, vmid and IP
+    
+    Maintained incrementally: update()/remove() touch only the entries of one
+    cache key, and sync() re-indexes only keys whose asset changed since the
+    last sync. Resolving a job's targets is then one dict lookup per target.
+    """
+    
+    def __init__(self):
+        self._assets = {}  # cache key -> (fingerprint, asset)
+        self._by_name = {}  # name -> [cache keys]
+        self._by_vmid = {}
+        self._by_ip = {}
+    
+    def __len__(self) -> int:
+        return len(self._assets)
+    
+    @staticmethod
+    def _fingerprint(asset: Dict[str, Any]) -> tuple:
+        return tuple(asset.get(field) for field in ("name", "vmid", "ip", "type", "host"))
+    
+    def _indexes(self, asset: Dict[str, Any]):
+        for index, field in ((self._by_name, "name"), (self._by_vmid, "vmid"), (self._by_ip, "ip")):
+            value = asset.get(field)
+            if value not in (None, ""):
+                yield index, str(value)
+    
+    def update(self, key: str, asset: Any):
+        """Index (or re-index) one discovery cache entry"""
+        if not isinstance(asset, dict):
+            self.remove(key)
+            return
+        fingerprint = self._fingerprint(asset)
+        current = self._assets.get(key)
+        if current and current[0] == fingerprint:
+            self._assets[key] = (fingerprint, asset)
+            return
+        self.remove(key)
+        self._assets[key] = (fingerprint, asset)
+        for index, value in self._indexes(asset):
+            index.setdefault(value, []).append(key)
+    
+    def remove(self, key: str):
+        """Drop one discovery cache entry from the index"""
+        current = self._assets.pop(key, None)
+        if not current:
+            return
+        for index, value in self._indexes(current[1]):
+            keys = index.get(value, [])
+            if key in keys:
+                keys.remove(key)
+            if not keys:
+                index.pop(value, None)
+    
+    def sync(self, cache: Dict[str, Any]):
+        """Bring the index in line with cache, re-indexing changed keys only"""
+        for key in [key for key in self._assets if key not in cache]:
+            self.remove(key)
+        for key, asset in cache.items():
+            self.update(key, asset)
+    
+    def lookup(self, identifier: str) -> Optional[Dict[str, Any]]:
+        """Find an asset by name, then vmid, then IP"""
+        identifier = str(identifier)
+        for index in (self._by_name, self._by_vmid, self._by_ip):
+            keys = index.get(identifier)
+            if keys:
+                return self._assets[keys[0]][1]
+        return None
+    
+    def resolve(self, identifiers: List[str]):
+        """Resolve many identifiers in one pass -> ({identifier: asset}, [unresolved])"""
+        resolved = {}
+        unresolved = []
+        for identifier in identifiers:
+            asset = self.lookup(identifier)
+            if asset is None:
+                unresolved.append(identifier)
+            else:
+                resolved[identifier] = asset
+        return resolved, unresolved
+
+class InventoryCache:
+    """Upgradable-package inventory per target, as last probed
+    
+    Entries come from dry-run probes and are served for `ttl` seconds, so
+    repeated dry runs and compliance views don't reconnect. A target is
+    dropped once it is patched (its inventory is stale by definition); a
+    new probe reporting the same apt-state fingerprint just renews it.
+    """
+    
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+        self._entries = {}  # target -> inventory
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, target: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(target)
+        if entry is not None and time.time() - entry["fetched_at"] > self.ttl:
+            del self._entries[target]
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+    
+    def record(self, target: str, result: Dict[str, Any]):
+        entry = self._entries.get(target)
+        if entry is not None and result.get("fingerprint") and entry["fingerprint"] == result["fingerprint"]:
+            entry["fetched_at"] = time.time()
+            return
+        self._entries[target] = {
+            "packages": list(result.get("packages", [])),
+            "security_packages": list(result.get("security_packages", [])),
+            "packages_available": result.get("packages_available", 0),
+            "security_updates": result.get("security_updates", 0),
+            "reboot_required": result.get("reboot_required", False),
+            "fingerprint": result.get("fingerprint"),
+            "fetched_at": time.time()
+        }
+    
+    def invalidate(self, target: str):
+        self._entries.pop(target, None)
+    
+    def snapshot(self, targets: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """Fresh entries (all, or just these targets), with their age in seconds"""
+        now = time.time()
+        return {
+            target: dict(entry, age=round(now - entry["fetched_at"], 1))
+            for target, entry in self._entries.items()
+            if (targets is None or target in targets) and now - entry["fetched_at"] <= self.ttl
+        }
+
+class PackageCacheStats:
+    """Hit/miss accounting from an apt-cacher-ng style transfer log
+    
+    Lines are "<unix time>|<type>|<bytes>|<client>|<path>": type "O" is a
+    file served to a client, "I" a file fetched from upstream. Each fetch
+    makes one serve of its path a miss: the earliest one in the window, from
+    whichever client (the proxy is shared, so that may be another job's
+    target). Every other serve was a hit, and its bytes were saved from the
+    mirror.
+    """
+    
+    LINE_RE = re.compile(r'^(\d+)\|([IO])\|(\d+)\|([^|]*)\|(.+)$')
+    
+    @classmethod
+    def summarize(cls, lines: List[str], since: float, until: float, clients: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Totals for the window, plus per client (only `clients`, if given)"""
+        fetched = {}
+        served = []
+        for line in lines:
+            match = cls.LINE_RE.match(line.strip())
+            if not match or not since <= int(match.group(1)) <= until:
+                continue
+            _, kind, size, client, path = match.groups()
+            if kind == "I":
+                fetched[path] = fetched.get(path, 0) + 1
+            else:
+                served.append((int(match.group(1)), client, path, int(size)))
+        
+        per_client = {}
+        # Fetches are matched against every client's serves before any are
+        # filtered out, so a fetch another client caused isn't charged here
+        for _, client, path, size in sorted(served, key=lambda serve: serve[0]):
+            miss = bool(fetched.get(path))
+            if miss:
+                fetched[path] -= 1
+            if clients is not None and client not in clients:
+                continue
+            stats = per_client.setdefault(client, {"hits": 0, "misses": 0, "bytes_served": 0, "bytes_saved": 0})
+            stats["bytes_served"] += size
+            if miss:
+                stats["misses"] += 1
+            else:
+                stats["hits"] += 1
+                stats["bytes_saved"] += size
+        
+        totals = {key: sum(stats[key] for stats in per_client.values()) for key in ("hits", "misses", "bytes_served", "bytes_saved")}
+        requests = totals["hits"] + totals["misses"]
+        totals["hit_rate"] = round(totals["hits"] / requests, 3) if requests else None
+        return dict(totals, clients=per_client)
+
+class ProxmoxTopology:
+    """Cluster nodes and guest placement, cached for `ttl` seconds
+    
+    fetch() returns the raw cluster state as pvesh reports it:
+    {"status": [...] (/cluster/status), "resources": [...] (/cluster/resources
+    --type vm)}. A failed refresh keeps serving the last good state.
+    notify_migration() updates a guest's placement at once and forces a
+    refresh on the next lookup.
+    """
+    
+    def __init__(self, fetch: Callable[[], Awaitable[Dict[str, Any]]], ttl: float = 60):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.nodes = {}  # node name -> {"ip", "online"}
+        self.guests = {}  # vmid -> {"node", "type", "name"}
+        self.refreshed_at = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def refresh(self, force: bool = False):
+        async with self._lock:
+            if not force and time.time() - self.refreshed_at < self.ttl:
+                return
+            try:
+                state = await self.fetch()
+            except Exception as e:
+                if not self.refreshed_at:
+                    raise
+                print(f"⚠️ Proxmox topology refresh failed, using cached state: {e}")
+                self.refreshed_at = time.time()  # don't hammer a broken source
+                return
+            nodes = {}
+            for entry in state.get("status", []):
+                if entry.get("type") == "node":
+                    nodes[entry["name"]] = {"ip": entry.get("ip"), "online": bool(entry.get("online", 1))}
+            guests = {}
+            for entry in state.get("resources", []):
+                if entry.get("vmid") is not None:
+                    guests[int(entry["vmid"])] = {"node": entry.get("node"), "type": entry.get("type"), "name": entry.get("name")}
+            self.nodes, self.guests = nodes, guests
+            self.refreshed_at = time.time()
+    
+    async def locate(self, vmid: Any) -> Dict[str, Any]:
+        """Node and node IP owning a guest; raises LookupError if it can't be routed"""
+        await self.refresh()
+        guest = self.guests.get(int(vmid)) if str(vmid).isdigit() else None
+        if guest is None:
+            raise LookupError(f"Guest {vmid} not found in the Proxmox cluster")
+        node = self.nodes.get(guest["node"])
+        if node is None or not node["ip"]:
+            raise LookupError(f"Guest {vmid} is on node {guest['node']!r}, which has no known address")
+        if not node["online"]:
+            raise LookupError(f"Guest {vmid} is on node {guest['node']!r}, which is offline")
+        return {"node": guest["node"], "node_ip": node["ip"]}
+    
+    def notify_migration(self, vmid: Any, node: Optional[str] = None):
+        if node is not None and int(vmid) in self.guests:
+            self.guests[int(vmid)]["node"] = node
+        self.invalidate()
+    
+    def invalidate(self):
+        """Refresh on the next lookup"""
+        self.refreshed_at = 0.0
+
+class SSHSessionPool:
+    """Persistent multiplexed SSH sessions (OpenSSH ControlMaster)
+    
+    One master connection per remote host is kept open in the background and
+    every ssh call rides it via ControlPath instead of doing its own
+    handshake. Masters are health-checked (ssh -O check) at most every
+    health_interval seconds and reopened when they have gone away.
+    """
+    
+    def __init__(self, ssh_binary: str = "/usr/bin/ssh", control_dir: Optional[str] = None, persist: int = 600):
+        self.ssh_binary = ssh_binary
+        self.control_dir = control_dir or os.path.join(tempfile.gettempdir(), "patching-ssh")
+        self.persist = persist  # seconds an idle master stays up
+        self.connect_timeout = 10
+        self.health_interval = 15  # seconds between -O check probes
+        self.handshake_time = {}  # host -> seconds the last master handshake took
+        self._checked_at = {}  # host -> time of last successful health check
+        self._locks = {}
+    
+    def _control_args(self) -> List[str]:
+        return ["-o", f"ControlPath={os.path.join(self.control_dir, '%C')}"]
+    
+    def base_args(self) -> List[str]:
+        return ["-o", f"ConnectTimeout={self.connect_timeout}", "-o", "BatchMode=yes"]
+    
+    async def _ssh_control(self, host: str, operation: str) -> bool:
+        proc = await asyncio.create_subprocess_exec(
+            self.ssh_binary, *self._control_args(), "-O", operation, host,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            return await asyncio.wait_for(proc.wait(), timeout=5) == 0
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return False
+    
+    async def _open_master(self, host: str) -> bool:
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        start = time.time()
+        # -f backgrounds ssh after authentication; stdio goes to /dev/null so
+        # the backgrounded master doesn't hold our pipes open
+        proc = await asyncio.create_subprocess_exec(
+            self.ssh_binary, *self.base_args(), *self._control_args(),
+            "-o", "ControlMaster=yes", "-o", f"ControlPersist={self.persist}",
+            "-f", "-N", host,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            returncode = await asyncio.wait_for(proc.wait(), timeout=self.connect_timeout + 5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return False
+        if returncode != 0:
+            return False
+        self.handshake_time[host] = time.time() - start
+        return True
+    
+    async def session_args(self, host: str, stats: Optional[Dict[str, Any]] = None) -> List[str]:
+        """ssh options routing a call through the host's master connection
+        
+        Opens (or reopens) the master if needed. If stats is given, it is
+        updated with connections reused and handshake time saved. Falls back
+        to a plain connection if no master can be established.
+        """
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            reused = True
+            if time.time() - self._checked_at.get(host, 0) > self.health_interval:
+                if not await self._ssh_control(host, "check"):
+                    reused = False
+                    if not await self._open_master(host):
+                        self._checked_at.pop(host, None)
+                        return self.base_args()
+                self._checked_at[host] = time.time()
+        
+        if stats is not None:
+            if reused:
+                stats["connections_reused"] = stats.get("connections_reused", 0) + 1
+                stats["handshake_saved_seconds"] = round(
+                    stats.get("handshake_saved_seconds", 0) + self.handshake_time.get(host, 0), 3
+                )
+            else:
+                stats["handshakes"] = stats.get("handshakes", 0) + 1
+        return self.base_args() + self._control_args() + ["-o", "ControlMaster=no"]
+    
+    def invalidate(self, host: str):
+        """Force a health check before the next call (e.g. after ssh exit 255)"""
+        self._checked_at.pop(host, None)
+    
+    async def close(self):
+        """Shut down every master connection"""
+        for host in list(self._locks):
+            await self._ssh_control(host, "exit")
+            self._checked_at.pop(host, None)
+
+class Transport(ABC):
+    """How shell commands reach the machine that runs Ansible
+    
+    run() executes a bash script there and returns a CompletedProcess with
+    the plain exit code and output. on_line (if given) is called with
+    ("stdout" | "stderr", line) per line; `streams` says whether that
+    happens while the command runs or only once it has exited. Timeouts
+    raise subprocess.TimeoutExpired.
+    """
+    
+    name = ""
+    streams = True
+    max_input = None  # bytes of stdin one run() may carry (None = unlimited)
+    
+    def __init__(self, runner: Callable[..., Awaitable[subprocess.CompletedProcess]]):
+        self.runner = runner  # PatchingOrchestrator._run_command
+    
+    @abstractmethod
+    async def run(
+        self,
+        script: str,
+        input: Optional[str] = None,
+        timeout: float = 60,
+        on_line: Optional[Callable[[str, str], None]] = None,
+        capture: bool = True,
+        stats: Optional[Dict[str, Any]] = None
+    ) -> subprocess.CompletedProcess:
+        ...
+
+class LocalTransport(Transport):
+    """Ansible installed next to the backend: run bash directly"""
+    
+    name = "local"
+    
+    async def run(self, script, input=None, timeout=60, on_line=None, capture=True, stats=None):
+        return await self.runner(["bash", "-c", script], input=input, timeout=timeout, on_line=on_line, capture=capture)
+
+class SSHTransport(Transport):
+    """Straight to the Ansible VM over the pooled SSH session"""
+    
+    name = "ssh"
+    
+    def __init__(self, runner, ssh_pool: SSHSessionPool, host: str):
+        super().__init__(runner)
+        self.ssh_pool = ssh_pool
+        self.host = host
+    
+    async def _ssh(self, remote_command: str, stats: Optional[Dict[str, Any]] = None, **kwargs) -> subprocess.CompletedProcess:
+        session_args = await self.ssh_pool.session_args(self.host, stats)
+        result = await self.runner([self.ssh_pool.ssh_binary, *session_args, self.host, remote_command], **kwargs)
+        if result.returncode == 255:
+            # ssh itself failed; re-check the master before the next call
+            self.ssh_pool.invalidate(self.host)
+        return result
+    
+    async def run(self, script, input=None, timeout=60, on_line=None, capture=True, stats=None):
+        return await self._ssh(
+            f"bash -c {shlex.quote(script)}", stats,
+            input=input, timeout=timeout, on_line=on_line, capture=capture
+        )
+
+class GuestExecTransport(SSHTransport):
+    """SSH to a Proxmox node, then qm guest exec into the Ansible VM
+    
+    The guest agent only hands output back, as one JSON envelope
+    (out-data/err-data/exitcode), after the command exits, so lines are
+    replayed to on_line at the end rather than streamed. Output beyond the
+    agent's buffer is truncated (flagged in stderr).
+    """
+    
+    name = "guest-exec"
+    streams = False
+    max_input = 1000 * 1000  # --pass-stdin is capped at 1 MiB
+    
+    def __init__(self, runner, ssh_pool: SSHSessionPool, host: str, vmid: int):
+        super().__init__(runner, ssh_pool, host)
+        self.vmid = vmid
+    
+    async def run(self, script, input=None, timeout=60, on_line=None, capture=True, stats=None):
+        # --timeout: qm otherwise gives up waiting after 30s and returns just the pid
+        remote_command = f"qm guest exec {self.vmid} --timeout {int(timeout) + 1}"
+        if input is not None:
+            remote_command += " --pass-stdin 1"
+        remote_command += f" -- bash -c {shlex.quote(script)}"
+        result = await self._ssh(remote_command, stats, input=input, timeout=timeout + 15)
+        
+        returncode, stdout, stderr = result.returncode, result.stdout, result.stderr
+        if stdout.lstrip().startswith("{"):
+            try:
+                envelope = json.loads(stdout)
+            except ValueError:
+                envelope = None
+            if isinstance(envelope, dict):
+                if "exitcode" not in envelope and "pid" in envelope:
+                    raise subprocess.TimeoutExpired(result.args, timeout)
+                returncode = envelope.get("exitcode", returncode)
+                stdout = envelope.get("out-data", "")
+                stderr = envelope.get("err-data", "") or result.stderr
+                if envelope.get("out-truncated") or envelope.get("err-truncated"):
+                    stderr += "\n[guest agent truncated the command output]"
+        
+        if on_line:
+            for line in stdout.splitlines():
+                on_line("stdout", line)
+            for line in stderr.splitlines():
+                on_line("stderr", line)
+        if not capture:
+            stdout = stderr = ""
+        return subprocess.CompletedProcess(result.args, returncode, stdout, stderr)
+
+class JobStore:
+    """Bounded, persistent job store backed by SQLite
+    
+    Jobs that haven't finished live in memory, because the orchestrator
+    updates them in place; save() writes them through. Finished jobs are
+    persisted and only a small LRU of recent ones is kept in memory.
+    Playbook output is spilled to gzip files under output/ and only read
+    back by get_output(); job rows never carry it.
+    """
+    
+    def __init__(self, data_dir: Path, recent_limit: int = 100):
+        self.data_dir = Path(data_dir)
+        self.output_dir = self.data_dir / "output"
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.recent_limit = recent_limit
+        self._live = {}  # job_id -> job (still being updated)
+        self.listeners = []  # called with each job as it is saved
+        self._recent = OrderedDict()  # job_id -> finished job
+        
+        self.db = sqlite3.connect(str(self.data_dir / "jobs.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs (created_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_status_created_at ON jobs (status, created_at);
+        """)
+        self._fail_interrupted()
+    
+    def _fail_interrupted(self):
+        """Jobs that were running when the process died will never finish"""
+        rows = self.db.execute(
+            "SELECT data FROM jobs WHERE status IN ('running', 'retrying')"
+        ).fetchall()
+        for (data,) in rows:
+            job = json.loads(data)
+            job["status"] = PatchJobStatus.FAILED.value
+            job["error"] = "Interrupted by backend restart"
+            job["completed_at"] = job.get("completed_at") or datetime.now().isoformat()
+            self._write(job)
+        self.db.commit()
+    
+    def _write(self, job: Dict[str, Any]):
+        self.db.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, status, created_at, data) VALUES (?, ?, ?, ?)",
+            (job["job_id"], job["status"], job["created_at"], json.dumps(job))
+        )
+    
+    def add(self, job: Dict[str, Any]):
+        self._live[job["job_id"]] = job
+        self.save(job)
+    
+    def load_live(self, status: str) -> List[Dict[str, Any]]:
+        """Bring every persisted job with this status back into the live set"""
+        rows = self.db.execute(
+            "SELECT data FROM jobs WHERE status = ? ORDER BY created_at", (status,)
+        ).fetchall()
+        jobs = []
+        for (data,) in rows:
+            job = json.loads(data)
+            job = self._live.setdefault(job["job_id"], job)
+            jobs.append(job)
+        return jobs
+    
+    def save(self, job: Dict[str, Any]):
+        """Persist the current state of a job"""
+        self._write(job)
+        self.db.commit()
+        for listener in self.listeners:
+            listener(job)
+    
+    def finish(self, job: Dict[str, Any]):
+        """Persist a finished job and move it out of the live set"""
+        self.save(job)
+        self._live.pop(job["job_id"], None)
+        self._recent[job["job_id"]] = job
+        while len(self._recent) > self.recent_limit:
+            self._recent.popitem(last=False)
+    
+    def __getitem__(self, job_id: str) -> Dict[str, Any]:
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job
+    
+    def __contains__(self, job_id: str) -> bool:
+        return self.get(job_id) is not None
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._live.get(job_id) or self._recent.get(job_id)
+        if job is not None:
+            return job
+        row = self.db.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def list(self, limit: int = 50, offset: int = 0, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Page through jobs, most recent first, optionally filtered by status"""
+        if status:
+            rows = self.db.execute(
+                "SELECT job_id, data FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (status, limit, offset)
+            ).fetchall()
+        else:
+            rows = self.db.execute(
+                "SELECT job_id, data FROM jobs ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (limit, offset)
+            ).fetchall()
+        # Live jobs may have progressed since they were last saved
+        return [self._live.get(job_id) or json.loads(data) for job_id, data in rows]
+    
+    def spill_output(self, job_id: str, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Write an output entry's stdout/stderr to a gzip file, returning a reference entry"""
+        job_dir = self.output_dir / job_id
+        job_dir.mkdir(exist_ok=True)
+        path = job_dir / f"{len(list(job_dir.iterdir()))}-{entry.get('type', 'output')}.json.gz"
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump({"stdout": entry.get("stdout", ""), "stderr": entry.get("stderr", "")}, f)
+        spilled = {key: value for key, value in entry.items() if key not in ("stdout", "stderr")}
+        spilled["output_file"] = path.name
+        spilled["output_bytes"] = len(entry.get("stdout", "")) + len(entry.get("stderr", ""))
+        return spilled
+    
+    def get_output(self, job_id: str) -> List[Dict[str, Any]]:
+        """Read a job's output entries back, including stdout/stderr"""
+        job = self.get(job_id)
+        if job is None:
+            return []
+        entries = []
+        for entry in job.get("output", []):
+            full = dict(entry)
+            path = self.output_dir / job_id / entry.get("output_file", "")
+            if entry.get("output_file") and path.exists():
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    full.update(json.load(f))
+            entries.append(full)
+        return entries
+
+class AuditLog:
+    """Append-only audit trail
+    
+    Recent entries are kept in an O(1) ring buffer for the dashboard. Every
+    entry is also appended to an indexed SQLite table; writes are batched so
+    there is one commit (and fsync) per batch_size entries or flush_interval
+    seconds rather than per event. Filtered queries go to SQLite.
+    """
+    
+    def __init__(self, data_dir: Path, recent_limit: int = 1000, batch_size: int = 50, flush_interval: float = 2.0):
+        self.recent = deque(maxlen=recent_limit)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._flush_scheduled = False
+        
+        Path(data_dir).mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(Path(data_dir) / "audit.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS audit_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT NOT NULL,
+                action TEXT NOT NULL,
+                job_id TEXT,
+                details TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_audit_timestamp ON audit_log (timestamp);
+            CREATE INDEX IF NOT EXISTS idx_audit_job_id ON audit_log (job_id, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_audit_action ON audit_log (action, timestamp);
+        """)
+    
+    def append(self, entry: Dict[str, Any]):
+        self.recent.append(entry)
+        self._pending.append(entry)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif not self._flush_scheduled:
+            try:
+                asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+                self._flush_scheduled = True
+            except RuntimeError:
+                self.flush()  # no event loop to batch on
+    
+    def flush(self):
+        """Write pending entries in a single transaction"""
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO audit_log (timestamp, action, job_id, details) VALUES (?, ?, ?, ?)",
+                [(e["timestamp"], e["action"], e["job_id"], json.dumps(e["details"])) for e in pending]
+            )
+    
+    def query(
+        self,
+        limit: int = 100,
+        job_id: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Entries matching every given filter, oldest first (last `limit` of them)
+        
+        since/until are ISO timestamps (inclusive / exclusive).
+        """
+        if not any((job_id, action, since, until)):
+            return list(islice(self.recent, max(len(self.recent) - limit, 0), None))
+        
+        self.flush()
+        clauses, params = [], []
+        for clause, value in (("job_id = ?", job_id), ("action = ?", action), ("timestamp >= ?", since), ("timestamp < ?", until)):
+            if value:
+                clauses.append(clause)
+                params.append(value)
+        rows = self.db.execute(
+            f"SELECT timestamp, action, job_id, details FROM audit_log WHERE {' AND '.join(clauses)} "
+            "ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (*params, limit)
+        ).fetchall()
+        return [
+            {"timestamp": ts, "action": act, "job_id": jid, "details": json.loads(details)}
+            for ts, act, jid, details in reversed(rows)
+        ]
+
+class JobEventBus:
+    """In-process pub/sub of job events with resumable cursors
+    
+    Every event gets a bus-wide sequence number and the last `history`
+    events are kept. A subscriber that reconnects with the last seq it saw
+    (e.g. SSE Last-Event-ID) gets what it missed; if that has already
+    dropped out of the history (or the backend restarted) it gets a
+    "resync" event first and should refetch the job.
+    """
+    
+    def __init__(self, history: int = 5000):
+        self._events = deque(maxlen=history)
+        self._seq = itertools.count(1)
+        self.last_seq = 0
+        self._waiters = set()  # one asyncio.Event per live subscriber
+    
+    def publish(self, job_id: Optional[str], event_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        self.last_seq = next(self._seq)
+        event = {
+            "seq": self.last_seq,
+            "job_id": job_id,
+            "type": event_type,
+            "timestamp": datetime.now().isoformat(),
+            "data": data
+        }
+        self._events.append(event)
+        for waiter in self._waiters:
+            waiter.set()
+        return event
+    
+    def since(self, cursor: int, job_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Retained events after cursor, optionally for one job only"""
+        if not self._events:
+            return []
+        start = max(cursor - self._events[0]["seq"] + 1, 0)
+        return [
+            event for event in islice(self._events, start, None)
+            if job_id is None or event["job_id"] == job_id
+        ]
+    
+    async def subscribe(self, job_id: Optional[str] = None, cursor: Optional[int] = None, keepalive: Optional[float] = None):
+        """Yield events after cursor (default: from now on), then live ones as they are published
+        
+        With keepalive, None is yielded whenever that many seconds pass
+        without an event.
+        """
+        cursor = self.last_seq if cursor is None else cursor
+        waiter = asyncio.Event()
+        self._waiters.add(waiter)
+        try:
+            while True:
+                # Clear before taking the batch and only go up to `latest`:
+                # anything published while the consumer is busy with a yield
+                # sets the waiter again and goes out in the next batch
+                waiter.clear()
+                latest = self.last_seq
+                oldest = self._events[0]["seq"] if self._events else latest + 1
+                if cursor > latest or cursor < oldest - 1:
+                    cursor = max(oldest - 1, 0)
+                    yield {"seq": cursor, "job_id": job_id, "type": "resync", "timestamp": datetime.now().isoformat(), "data": {}}
+                for event in [event for event in self.since(cursor, job_id) if event["seq"] <= latest]:
+                    yield event
+                cursor = latest
+                try:
+                    await asyncio.wait_for(waiter.wait(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            self._waiters.discard(waiter)
+
+class JobScheduler:
+    """Timer heap of scheduled jobs
+    
+    A single asyncio task sleeps until the earliest entry is due (or an
+    earlier one is added), then hands every due job, plus any falling due
+    within coalesce_seconds, to dispatch() as one batch so they can share a
+    playbook run.
+    """
+    
+    def __init__(self, dispatch: Callable[[List[str]], None], coalesce_seconds: float = 60):
+        self.dispatch = dispatch
+        self.coalesce_seconds = coalesce_seconds
+        self._heap = []  # (run_at timestamp, seq, job_id)
+        self._seq = itertools.count()
+        self._cancelled = set()
+        self._wake = None
+        self._task = None
+    
+    def __len__(self) -> int:
+        return len(self._heap) - len(self._cancelled)
+    
+    def add(self, job_id: str, run_at: datetime):
+        self._cancelled.discard(job_id)
+        heapq.heappush(self._heap, (run_at.timestamp(), next(self._seq), job_id))
+        if self._wake is not None:
+            self._wake.set()
+    
+    def cancel(self, job_id: str):
+        self._cancelled.add(job_id)
+    
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            due = []
+            horizon = time.time() + self.coalesce_seconds
+            while self._heap and self._heap[0][0] <= horizon:
+                _, _, job_id = heapq.heappop(self._heap)
+                if job_id in self._cancelled:
+                    self._cancelled.discard(job_id)
+                elif job_id not in due:
+                    due.append(job_id)
+            if due:
+                try:
+                    self.dispatch(due)
+                except Exception as e:
+                    print(f"⚠️ Scheduler dispatch failed: {e}")
+
+class JobQueueFullError(Exception):
+    """The job executor's queue is saturated; retry later"""
+
+class JobExecutor:
+    """Bounded pool running queued jobs in priority order
+    
+    At most `workers` jobs run at once. A job only starts when none of its
+    targets is being patched by another job (two apt runs on one machine
+    just fight over the dpkg lock) and each Proxmox node it touches has
+    fewer than node_limit jobs on it. A blocked job reserves its targets,
+    so later jobs can't keep jumping ahead of it. submit() raises
+    JobQueueFullError once max_queue jobs are waiting.
+    """
+    
+    PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+    
+    def __init__(self, workers: int = 2, max_queue: int = 50, node_limit: int = 1):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.node_limit = node_limit
+        self._queue = []  # heap of (priority rank, seq, entry)
+        self._seq = itertools.count()
+        self._running = {}  # job_id -> entry
+        self._busy_targets = set()
+        self._node_load = {}  # node -> running jobs touching it
+    
+    def __len__(self) -> int:
+        return len(self._queue)
+    
+    def submit(
+        self,
+        job_id: str,
+        run: Callable[[], Any],
+        targets: List[str],
+        nodes: List[str],
+        priority: str = "normal"
+    ) -> int:
+        """Queue run() (a coroutine function) and return the job's queue position"""
+        if priority not in self.PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority} (expected one of {', '.join(self.PRIORITIES)})")
+        if len(self._queue) >= self.max_queue:
+            raise JobQueueFullError(f"Job queue is full ({len(self._queue)} jobs waiting)")
+        entry = {
+            "job_id": job_id,
+            "run": run,
+            "targets": set(targets),
+            "nodes": set(nodes),
+            "priority": priority,
+            "queued_at": time.time()
+        }
+        heapq.heappush(self._queue, (self.PRIORITIES[priority], next(self._seq), entry))
+        self._pump()
+        return self.position(job_id)
+    
+    def cancel(self, job_id: str) -> bool:
+        """Drop a job that hasn't started yet"""
+        for item in self._queue:
+            if item[2]["job_id"] == job_id:
+                self._queue.remove(item)
+                heapq.heapify(self._queue)
+                return True
+        return False
+    
+    def position(self, job_id: str) -> Optional[int]:
+        """1-based place in the queue, 0 if running, None if unknown"""
+        if job_id in self._running:
+            return 0
+        for index, (_, _, entry) in enumerate(sorted(self._queue, key=lambda item: item[:2])):
+            if entry["job_id"] == job_id:
+                return index + 1
+        return None
+    
+    def depth(self) -> Dict[str, Any]:
+        """Queue depth and pool usage for status reporting"""
+        now = time.time()
+        by_priority = {priority: 0 for priority in self.PRIORITIES}
+        for _, _, entry in self._queue:
+            by_priority[entry["priority"]] += 1
+        return {
+            "queued": len(self._queue),
+            "running": len(self._running),
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "saturated": len(self._queue) >= self.max_queue,
+            "by_priority": by_priority,
+            "oldest_wait_seconds": round(max((now - entry["queued_at"] for _, _, entry in self._queue), default=0), 1),
+            "busy_targets": len(self._busy_targets),
+            "node_load": dict(self._node_load)
+        }
+    
+    def _pump(self):
+        """Start every queued job that can run now, best priority first"""
+        reserved = set()
+        for item in sorted(self._queue, key=lambda item: item[:2]):
+            if len(self._running) >= self.workers:
+                break
+            entry = item[2]
+            if (entry["targets"] & (self._busy_targets | reserved)
+                    or any(self._node_load.get(node, 0) >= self.node_limit for node in entry["nodes"])):
+                reserved |= entry["targets"]
+                continue
+            self._queue.remove(item)
+            self._busy_targets |= entry["targets"]
+            for node in entry["nodes"]:
+                self._node_load[node] = self._node_load.get(node, 0) + 1
+            self._running[entry["job_id"]] = entry
+            asyncio.create_task(self._run(entry))
+        heapq.heapify(self._queue)
+    
+    async def _run(self, entry: Dict[str, Any]):
+        try:
+            await entry["run"]()
+        except Exception as e:
+            print(f"⚠️ Job {entry['job_id']} crashed: {e}")
+        finally:
+            del self._running[entry["job_id"]]
+            self._busy_targets -= entry["targets"]
+            for node in entry["nodes"]:
+                self._node_load[node] -= 1
+                if not self._node_load[node]:
+                    del self._node_load[node]
+            self._pump()
+
 class PatchingOrchestrator:
     """Orchestrates patching via Ansible
     
@@ -38,269 +1265,454 @@ class PatchingOrchestrator:
     - Error recovery with retry logic
     - Per-host progress tracking
     - Audit logging
+    - Non-blocking subprocess execution (asyncio)
     """
     
-    # Embedded playbook content (deployed automatically)
-    PATCH_CONTAINERS_PLAYBOOK = """---
-- name: Patch LXC Containers via Proxmox
-  hosts: localhost
-  become: yes
-  gather_facts: no
-  
-  vars:
-    containers: "{{ target_containers | default([]) }}"
-    security_only: "{{ patch_type | default('all') == 'security' }}"
-    dry_run: "{{ dry_run_mode | default(false) }}"
-    proxmox_nodes: ["pve-scratchy", "pve-itchy"]
-  
-  tasks:
-    - name: Count updates per container
-      shell: |
-        pct exec {{ item.ct_id }} -- bash -c "
-          apt list --upgradable 2>/dev/null | tail -n+2 | wc -l
-        "
-      loop: "{{ containers }}"
-      register: container_counts
-      changed_when: false
-    
-    - name: Count security updates per container
-      shell: |
-        pct exec {{ item.ct_id }} -- bash -c "
-          apt list --upgradable 2>/dev/null | grep -i security | wc -l
-        "
-      loop: "{{ containers }}"
-      register: container_security_counts
-      changed_when: false
-      failed_when: false
-    
-    - name: Upgrade packages (security only)
-      shell: |
-        pct exec {{ item.ct_id }} -- bash -c "
-          export DEBIAN_FRONTEND=noninteractive &&
-          apt update &&
-          apt upgrade -y $(apt list --upgradable 2>/dev/null | grep -i security | cut -d/ -f1 | tr '\\n' ' ') &&
-          apt autoremove -y &&
-          apt autoclean
-        "
-      loop: "{{ containers }}"
-      when: 
-        - not dry_run
-        - container_security_counts.results[loop.index0].stdout | int > 0
-        - security_only
-      register: container_upgrade_security
-    
-    - name: Upgrade all packages
-      shell: |
-        pct exec {{ item.ct_id }} -- bash -c "
-          export DEBIAN_FRONTEND=noninteractive &&
-          apt update &&
-          apt upgrade -y &&
-          apt autoremove -y &&
-          apt autoclean
-        "
-      loop: "{{ containers }}"
-      when: 
-        - not dry_run
-        - container_counts.results[loop.index0].stdout | int > 0
-        - not security_only
-      register: container_upgrade_all
-    
-    - name: Final status
-      debug:
-        msg: "Container patching {{ 'completed' if not dry_run else 'dry-run completed' }}"
-"""
-
-    PATCH_DEBIAN_PLAYBOOK = """---
-- name: Patch Debian/Ubuntu Systems
-  hosts: "{{ target_hosts | default('all') }}"
-  become: yes
-  gather_facts: yes
-  
-  vars:
-    security_only: "{{ patch_type | default('all') == 'security' }}"
-    dry_run: "{{ dry_run_mode | default(false) }}"
-  
-  tasks:
-    - name: Update apt cache
-      apt:
-        update_cache: yes
-        cache_valid_time: 3600
-    
-    - name: Count upgradable packages
-      command: apt list --upgradable 2>/dev/null | tail -n+2 | wc -l
-      register: package_count
-      changed_when: false
-    
-    - name: Count security updates
-      command: apt list --upgradable 2>/dev/null | grep -i security | wc -l
-      register: security_count
-      changed_when: false
-      failed_when: false
-    
-    - name: Upgrade packages (security only)
-      apt:
-        upgrade: dist
-        update_cache: yes
-        autoremove: yes
-        autoclean: yes
-      when: not dry_run and security_only and security_count.stdout | int > 0
-      register: upgrade_result
-    
-    - name: Upgrade all packages
-      apt:
-        upgrade: dist
-        update_cache: yes
-        autoremove: yes
-        autoclean: yes
-      when: not dry_run and not security_only and package_count.stdout | int > 0
-      register: upgrade_result
-    
-    - name: Final status
-      debug:
-        msg: "Patching {{ 'completed' if not dry_run else 'dry-run completed' }}"
-"""
+    # Playbooks deployed from ansible-playbooks/
+    PLAYBOOK_FILES = ("patch-containers-simple.yml", "patch-debian.yml")
     
-    def __init__(self):
-        self.jobs = {}  # job_id -> job_data
+    # ISO 8601 duration, as used in repeating-interval schedules
+    DURATION_RE = re.compile(r'^P(?:(?P<weeks>\d+)W)?(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+)S)?)?$')
+    
+    # Job fields carried by "status" events
+    STATUS_FIELDS = ("status", "error", "error_category", "retry_count", "started_at", "completed_at", "scheduled_for", "phases")
+    
+    def __init__(self, data_dir: Optional[str] = None):
+        self.data_dir = Path(data_dir or os.environ.get("PATCHING_DATA_DIR") or DEFAULT_DATA_DIR)
+        self.jobs = JobStore(self.data_dir)  # job_id -> job_data
         self.ansible_host = "pve-scratchy"
         self.ansible_vm = 102
         self.playbook_path = "/etc/ansible/playbooks/patching"
-        self.max_retries = 3
-        self.retry_delay = 5  # seconds
-        self.audit_log = []  # Audit trail
+        # Retry policy per error category: attempts per target (1 = never
+        # retried), and backoff "constant", "linear" or "exponential" from
+        # base_delay seconds, capped at max_delay
+        self.retry_policies = {
+            ErrorCategory.NETWORK.value: {"max_attempts": 4, "backoff": "exponential", "base_delay": 5, "max_delay": 300},
+            ErrorCategory.TIMEOUT.value: {"max_attempts": 2, "backoff": "constant", "base_delay": 30, "max_delay": 30},
+            ErrorCategory.LOCK.value: {"max_attempts": 5, "backoff": "linear", "base_delay": 20, "max_delay": 120},
+            ErrorCategory.PERMISSION.value: {"max_attempts": 1},
+            ErrorCategory.PACKAGE.value: {"max_attempts": 1},  # a broken package won't fix itself
+            ErrorCategory.UNKNOWN.value: {"max_attempts": 3, "backoff": "exponential", "base_delay": 5, "max_delay": 300}
+        }
+        self.host_retry_budgets = {}  # target -> attempts, caps the category's max_attempts
+        self.error_classifier = ErrorClassifier()
+        self._load_error_config(os.environ.get("PATCHING_ERROR_RULES"))
+        self.default_node_container_limit = 4  # containers patched at once per Proxmox node
+        self.node_container_limits = {}  # node -> limit, e.g. {"pve-itchy": 2}
+        self.max_parallel_containers = 8  # across all nodes
+        self.container_shard_size = 200  # containers per playbook run; bigger nodes get several runs
+        self.phase_timeouts = {"containers": 7200, "hosts": 7200}  # seconds per phase, retries included
+        # Wave rollout (apply_patches(rollout=...)): canary wave, then the window
+        # grows by `increase` after a clean wave and halves after a failed or
+        # slow one (slower than slow_factor x the canary). The rollout halts
+        # once failures pass failure_threshold, any canary fails, or a
+        # category reaches its `systemic` count.
+        self.rollout_defaults = {
+            "canary": 1,
+            "initial": 2,
+            "increase": 2,
+            "max_window": 16,
+            "failure_threshold": 0.2,
+            "slow_factor": 2.0,
+            "systemic": {ErrorCategory.PERMISSION.value: 1, ErrorCategory.PACKAGE.value: 2}
+        }
+        self.audit_log = AuditLog(self.data_dir)  # Audit trail
+        self.events = JobEventBus()  # live job updates for dashboards (see stream_job_events)
+        self._published_status = {}  # job_id -> last status event sent
+        self.jobs.listeners.append(self._publish_status)
+        self.asset_index = AssetIndex()  # name/vmid/IP -> discovery cache entry
+        self._asset_index_hooked = False  # True once discovery pushes updates itself
+        self.ssh_pool = SSHSessionPool()  # multiplexed sessions to the Ansible host
+        # Cluster nodes and container placement: pvesh on ansible_host, or a
+        # JSON file of the same shape (PATCHING_TOPOLOGY_FILE) for tests
+        self.topology_file = os.environ.get("PATCHING_TOPOLOGY_FILE")
+        self.topology = ProxmoxTopology(self._fetch_topology, ttl=60)
+        # How commands reach Ansible: "guest-exec" (ssh to ansible_host, then qm
+        # guest exec into ansible_vm), "ssh" (straight to ansible_ssh_host) or "local"
+        self.transport_name = os.environ.get("PATCHING_TRANSPORT", "guest-exec")
+        self.ansible_ssh_host = os.environ.get("PATCHING_ANSIBLE_SSH_HOST")  # e.g. "root@10.16.1.30"
         self._playbooks_deployed = False
+        self._deploy_task = None  # background playbook deployment (see start())
+        self.scheduler = JobScheduler(self._dispatch_scheduled)
+        self.executor = JobExecutor(workers=2, max_queue=50, node_limit=1)  # limits concurrent ansible runs
+        self.queue_defer_seconds = 300  # scheduled jobs that find the queue full retry this much later
+        self.reprobe_delay = 120  # seconds after a job before its patched targets are re-probed
+        self.inventory = InventoryCache(ttl=3600)  # upgradable packages per target, from dry runs
+        self.apt_lists_max_age = 3600  # dry runs reuse apt lists refreshed this recently
+        # Prefetch (download-only) runs ahead of a window: at most
+        # prefetch_parallel targets download at once, apply_patches(prefetch=True)
+        # schedules one prefetch_lead seconds before the run, and a run within
+        # prefetch_max_age of a target's prefetch installs from its cache
+        self.prefetch_parallel = 4
+        self.prefetch_lead = 3600
+        self.prefetch_max_age = 12 * 3600
+        self.prefetched = {}  # target -> {"job_id", "at", "staged_bytes", "cache_bytes"}
+        # Shared caching proxy for apt (e.g. "http://10.16.1.30:3142"), used
+        # only for the duration of each job. Hit/miss stats come from its log,
+        # read over ssh on apt_cache_host (default: the proxy's host), or from
+        # a local file of the same format (PATCHING_APT_CACHE_LOG) for tests
+        self.apt_proxy = os.environ.get("PATCHING_APT_PROXY")
+        self.apt_cache_host = os.environ.get("PATCHING_APT_CACHE_HOST")
+        self.apt_cache_log = os.environ.get("PATCHING_APT_CACHE_LOG")
+        self.apt_cache_remote_log = "/var/log/apt-cacher-ng/apt-cacher.log"
+        # Maintenance windows, e.g. {"weekdays": [5, 6], "start": "02:00", "duration_minutes": 180}
+        # (weekdays optional, Monday = 0). Empty = scheduled jobs may run at any time.
+        self.maintenance_windows = []
+        self.stream_line_limit = 32 * 1024 * 1024  # qm guest exec returns output as one JSON line
+        self.output_tail_lines = 2000  # playbook output kept per run
+        self.ansible_callback = "ansible.posix.jsonl"  # one JSON event per line
         
-        # Deploy playbooks automatically on first use
-        # Note: Deferred to avoid blocking initialization
+        # Playbooks are deployed by start() at application startup, or on
+        # first use if start() was never called
     
-    def _ensure_playbooks_deployed(self):
-        """Ensure playbooks are deployed to VM 102 via git pull"""
-        if self._playbooks_deployed:
-            return
+    async def _run_command(
+        self,
+        cmd: List[str],
+        input: Optional[str] = None,
+        timeout: float = 60,
+        on_line: Optional[Callable[[str, str], None]] = None,
+        capture: bool = True
+    ) -> subprocess.CompletedProcess:
+        """Run a command on the event loop without blocking it
+        
+        stdout/stderr are read incrementally; on_line (if given) is called
+        with ("stdout" | "stderr", line) as each line arrives. With
+        capture=False the output is only streamed, not accumulated. On timeout
+        the process is killed and subprocess.TimeoutExpired is raised, same as
+        subprocess.run().
+        """
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=self.stream_line_limit
+        )
+        captured = {"stdout": [], "stderr": []}
+        
+        async def pump(stream, name):
+            while True:
+                line = await stream.readline()
+                if not line:
+                    break
+                text = line.decode("utf-8", errors="replace")
+                if capture:
+                    captured[name].append(text)
+                if on_line:
+                    on_line(name, text.rstrip("\n"))
+        
+        async def feed():
+            if input is None:
+                return
+            try:
+                proc.stdin.write(input.encode("utf-8"))
+                await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                proc.stdin.close()
         
         try:
-            # Use git to pull playbooks from repository
-            # This is much more reliable than stdin/base64 deployment
-            repo_url = "https://github.com/dpgetmassive/DevOps-Brain.git"
-            repo_path = "/tmp/gm-agentic-devops-brain"
-            playbooks_source = f"{repo_path}/projects/patch-compliance-dashboard/ansible-playbooks"
-            
-            # Deploy script that clones/updates repo and copies playbooks
-            deploy_script = f'''#!/bin/bash
-set -e
-
-playbook_dir="{self.playbook_path}"
-repo_path="{repo_path}"
-playbooks_source="{playbooks_source}"
-
-# Create playbook directory
-mkdir -p "$playbook_dir"
-
-# Clone or update repository
-if [ -d "$repo_path" ]; then
-    echo "Repository exists, pulling latest changes..."
-    cd "$repo_path"
-    git pull --quiet || git fetch --quiet && git reset --hard origin/main
-else
-    echo "Cloning repository..."
-    git clone --depth 1 --quiet "$repo_url" "$repo_path"
-fi
-
-# Copy playbooks to target directory
-if [ -f "$playbooks_source/patch-containers-simple.yml" ] && [ -f "$playbooks_source/patch-debian.yml" ]; then
-    cp "$playbooks_source/patch-containers-simple.yml" "$playbook_dir/"
-    cp "$playbooks_source/patch-debian.yml" "$playbook_dir/"
-    echo "Playbooks deployed successfully"
-elif [ -f "$playbooks_source/patch-containers.yml" ] && [ -f "$playbooks_source/patch-debian.yml" ]; then
-    # Fallback to old playbook name
-    cp "$playbooks_source/patch-containers.yml" "$playbook_dir/"
-    cp "$playbooks_source/patch-debian.yml" "$playbook_dir/"
-    echo "Playbooks deployed successfully (using fallback)"
-else
-    echo "ERROR: Playbook files not found in repository" >&2
-    exit 1
-fi
-'''
-            
-            # Execute deployment script on VM
-            exec_cmd = [
-                "/usr/bin/ssh", "-o", "ConnectTimeout=10", "-o", "BatchMode=yes",
-                self.ansible_host,
-                f"qm guest exec {self.ansible_vm} -- bash"
-            ]
-            
-            exec_result = subprocess.run(
-                exec_cmd,
-                input=deploy_script,
-                capture_output=True,
-                text=True,
-                timeout=60
+            await asyncio.wait_for(
+                asyncio.gather(feed(), pump(proc.stdout, "stdout"), pump(proc.stderr, "stderr"), proc.wait()),
+                timeout=timeout
             )
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise subprocess.TimeoutExpired(
+                cmd, timeout,
+                output="".join(captured["stdout"]),
+                stderr="".join(captured["stderr"])
+            )
+        except BaseException:
+            # Cancelled job: don't leave ssh/ansible running behind us
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        
+        return subprocess.CompletedProcess(
+            cmd, proc.returncode, "".join(captured["stdout"]), "".join(captured["stderr"])
+        )
+    
+    def _transport(self, name: Optional[str] = None) -> Transport:
+        """The configured transport to the Ansible machine (or the named one)"""
+        name = name or self.transport_name
+        if name == "guest-exec":
+            return GuestExecTransport(self._run_command, self.ssh_pool, self.ansible_host, self.ansible_vm)
+        if name == "ssh":
+            if not self.ansible_ssh_host:
+                raise ValueError("ssh transport needs ansible_ssh_host (PATCHING_ANSIBLE_SSH_HOST)")
+            return SSHTransport(self._run_command, self.ssh_pool, self.ansible_ssh_host)
+        if name == "local":
+            return LocalTransport(self._run_command)
+        raise ValueError(f"Unknown transport: {name}")
+    
+    async def _run_remote(self, script: str, job: Optional[Dict[str, Any]] = None, **kwargs) -> subprocess.CompletedProcess:
+        """Run a bash script on the Ansible machine through the configured transport"""
+        stats = job.setdefault("ssh", {}) if job is not None else None
+        return await self._transport().run(script, stats=stats, **kwargs)
+    
+    async def benchmark_transports(
+        self,
+        transports: Optional[List[str]] = None,
+        rounds: int = 5,
+        payload_bytes: int = 4 * 1024 * 1024
+    ) -> Dict[str, Any]:
+        """Compare transports: per-call latency, time to first output line and bulk output
+        
+        A transport that isn't configured or reachable reports an error
+        instead of numbers.
+        """
+        results = {}
+        for name in transports or ["guest-exec", "ssh", "local"]:
+            try:
+                transport = self._transport(name)
+                latencies = []
+                for _ in range(rounds):
+                    start = time.perf_counter()
+                    result = await transport.run("true", timeout=30)
+                    if result.returncode != 0:
+                        raise RuntimeError(result.stderr.strip() or f"exit code {result.returncode}")
+                    latencies.append(time.perf_counter() - start)
+                latencies.sort()
+                
+                # A streaming transport delivers the first line a second before the command ends
+                first_line = []
+                start = time.perf_counter()
+                await transport.run(
+                    "echo ready; sleep 1; echo done",
+                    timeout=30,
+                    on_line=lambda stream, line: first_line or first_line.append(time.perf_counter() - start)
+                )
+                
+                expected = len(base64.encodebytes(bytes(payload_bytes)))
+                start = time.perf_counter()
+                result = await transport.run(f"head -c {payload_bytes} /dev/zero | base64 -w 76", timeout=120)
+                elapsed = time.perf_counter() - start
+                received = len(result.stdout)
+                
+                results[name] = {
+                    "streams": transport.streams,
+                    "latency_ms": {
+                        "min": round(latencies[0] * 1000, 1),
+                        "median": round(latencies[len(latencies) // 2] * 1000, 1),
+                        "max": round(latencies[-1] * 1000, 1)
+                    },
+                    "first_line_ms": round(first_line[0] * 1000, 1) if first_line else None,
+                    "output_bytes": expected,
+                    "received_bytes": received,
+                    "truncated": received < expected,
+                    "throughput_mib_s": round(received / elapsed / 2**20, 2)
+                }
+            except Exception as e:
+                results[name] = {"error": str(e) or type(e).__name__}
+        return results
+    
+    async def shutdown(self):
+        """Flush the audit log and release pooled SSH sessions (call on application shutdown)"""
+        self.audit_log.flush()
+        await self.ssh_pool.close()
+    
+    def _playbook_bundle(self) -> Dict[str, bytes]:
+        """Playbook files to deploy, by file name, from the ansible-playbooks/
+        directory shipped with the dashboard
+        
+        Raises FileNotFoundError if any of them is missing: jobs can't run
+        without the playbooks the parser is written against.
+        """
+        bundle, missing = {}, []
+        for name in self.PLAYBOOK_FILES:
+            try:
+                bundle[name] = (PLAYBOOK_DIR / name).read_bytes()
+            except OSError:
+                missing.append(name)
+        if missing:
+            raise FileNotFoundError(f"Playbooks missing from {PLAYBOOK_DIR}: {', '.join(missing)}")
+        return bundle
+    
+    async def _remote_playbook_hashes(self) -> Dict[str, str]:
+        """sha256 of every playbook currently deployed on the Ansible machine"""
+        result = await self._run_remote(f"cd {self.playbook_path} 2>/dev/null && sha256sum *.yml", timeout=15)
+        hashes = {}
+        for line in result.stdout.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                hashes[parts[1].lstrip("*")] = parts[0]
+        return hashes
+    
+    async def _deploy_playbooks(self) -> bool:
+        """Sync playbooks to the Ansible machine, transferring only files whose content hash differs
+        
+        A missing local playbook raises instead of returning False, so it
+        fails the jobs waiting on deployment rather than being retried.
+        """
+        try:
+            bundle = self._playbook_bundle()
+        except FileNotFoundError as e:
+            print(f"⚠️ Cannot deploy playbooks: {e}")
+            raise
+        local_hashes = {name: hashlib.sha256(content).hexdigest() for name, content in bundle.items()}
+        
+        try:
+            remote_hashes = await self._remote_playbook_hashes()
+            changed = [name for name, digest in local_hashes.items() if remote_hashes.get(name) != digest]
+            if not changed:
+                self._playbooks_deployed = True
+                return True
             
-            # Parse qm guest exec JSON output
-            stdout = exec_result.stdout
-            stderr = exec_result.stderr
-            if stdout.strip().startswith('{'):
-                try:
-                    json_output = json.loads(stdout)
-                    stdout = json_output.get('out-data', stdout)
-                    if 'err-data' in json_output:
-                        stderr = json_output.get('err-data', stderr)
-                except:
-                    pass
-            
-            # Verify deployment
-            verify_cmd = [
-                "/usr/bin/ssh", "-o", "ConnectTimeout=10", "-o", "BatchMode=yes",
-                self.ansible_host,
-                f"qm guest exec {self.ansible_vm} -- bash -c 'wc -l {self.playbook_path}/*.yml 2>/dev/null || echo \"Files not found\"'"
-            ]
+            # One round trip: write each changed file atomically, then report
+            # the hashes of what actually landed on disk
+            script = ["set -e", f"mkdir -p {self.playbook_path}", f"cd {self.playbook_path}"]
+            for name in changed:
+                encoded = base64.b64encode(bundle[name]).decode("ascii")
+                script.append(f"base64 -d > .{name}.tmp <<'PLAYBOOK_EOF'\n{encoded}\nPLAYBOOK_EOF")
+                script.append(f"mv .{name}.tmp {name}")
+            script.append("sha256sum " + " ".join(changed))
             
-            verify_result = subprocess.run(
-                verify_cmd,
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
+            result = await self._run_remote("bash -s", input="\n".join(script) + "\n", timeout=60)
             
-            verify_output = verify_result.stdout
-            if verify_output.strip().startswith('{'):
-                try:
-                    json_output = json.loads(verify_output)
-                    verify_output = json_output.get('out-data', verify_output)
-                except:
-                    pass
+            written = {}
+            for line in result.stdout.splitlines():
+                parts = line.split()
+                if len(parts) == 2:
+                    written[parts[1].lstrip("*")] = parts[0]
             
-            # Check if files were written (non-zero line count)
-            if exec_result.returncode == 0 and "Playbooks deployed successfully" in stdout:
-                # Extract line counts
-                import re
-                containers_match = re.search(r'(\d+)\s+.*patch-containers\.yml', verify_output)
-                debian_match = re.search(r'(\d+)\s+.*patch-debian\.yml', verify_output)
-                
-                if containers_match and debian_match:
-                    containers_lines = int(containers_match.group(1))
-                    debian_lines = int(debian_match.group(1))
-                    
-                    if containers_lines > 0 and debian_lines > 0:
-                        self._playbooks_deployed = True
-                        print("✅ Playbooks deployed successfully via git")
-                        return
+            if result.returncode == 0 and all(written.get(name) == local_hashes[name] for name in changed):
+                self._playbooks_deployed = True
+                print(f"✅ Playbooks deployed ({', '.join(changed)})")
+                return True
             
-            # If we get here, deployment failed
-            print(f"⚠️ Playbook deployment warning: returncode={exec_result.returncode}")
-            print(f"   stdout: {stdout[:500]}")
-            print(f"   stderr: {stderr[:500]}")
-            print(f"   verify: {verify_output[:300]}")
+            print(f"⚠️ Playbook deployment warning: returncode={result.returncode}")
+            print(f"   stdout: {result.stdout[:500]}")
+            print(f"   stderr: {result.stderr[:500]}")
         except Exception as e:
             print(f"⚠️ Failed to deploy playbooks (will retry on use): {e}")
+        return False
+    
+    async def start(self):
+        """Startup warm-up: deploy playbooks in the background and resume scheduled jobs
+        
+        Scheduled jobs are reloaded from the job store; any that fell due
+        while the backend was down run straight away (catch-up).
+        """
+        if self._deploy_task is None:
+            self._deploy_task = asyncio.create_task(self._deploy_playbooks())
+        for job in self.jobs.load_live(PatchJobStatus.SCHEDULED.value):
+            self.scheduler.add(job["job_id"], datetime.fromisoformat(job["scheduled_for"]))
+        self.scheduler.start()
+        # Jobs still queued when the backend stopped never ran; queue them again
+        for job in self.jobs.load_live(PatchJobStatus.PENDING.value):
+            try:
+                self._submit(job)
+            except JobQueueFullError as e:
+                job["status"] = PatchJobStatus.FAILED.value
+                job["error"] = str(e)
+                job["completed_at"] = datetime.now().isoformat()
+                self.jobs.finish(job)
+    
+    async def _ensure_playbooks_deployed(self):
+        """Wait for the playbook deployment, restarting it if the last attempt failed
+        
+        Raises if it fails again: the playbooks already on the Ansible machine
+        may predate the task names the parser relies on, so running them
+        could report targets as patched without probing them.
+        """
+        if self._playbooks_deployed:
+            return
+        if self._deploy_task is None or (self._deploy_task.done() and not self._deploy_task.result()):
+            self._deploy_task = asyncio.create_task(self._deploy_playbooks())
+        if not await asyncio.shield(self._deploy_task):
+            raise RuntimeError("Playbook deployment to the Ansible machine failed")
+    
+    def _count_playbook_tasks(self, playbook_name: str) -> int:
+        """Number of TASK headers a playbook run will print (0 if unknown)"""
+        try:
+            content = (PLAYBOOK_DIR / playbook_name).read_text()
+        except OSError:
+            return 0
+        tasks = len(re.findall(r'^\s*- name:', content, re.MULTILINE)) - len(re.findall(r'^- name:', content, re.MULTILINE))
+        if re.search(r'^\s*gather_facts:\s*(yes|true)', content, re.MULTILINE):
+            tasks += 1
+        return tasks
+    
+    async def _stream_playbook(
+        self,
+        job: Dict[str, Any],
+        phase: str,
+        playbook_args: List[str],
+        parser: AnsibleOutputParser,
+        timeout: float = 1800
+    ) -> subprocess.CompletedProcess:
+        """Run ansible-playbook, feeding its output to parser and job progress as it arrives
+        
+        Progress is live on streaming transports; guest-exec delivers it all
+        when the run ends. The returned CompletedProcess carries the output
+        tail, not the full stdout.
+        """
+        stderr_tail = deque(maxlen=self.output_tail_lines)
+        
+        def on_line(stream: str, line: str):
+            if stream == "stderr":
+                stderr_tail.append(line)
+            else:
+                parser.feed(line)
+                self._update_job_progress(job, phase, parser)
+        
+        script = f"ANSIBLE_STDOUT_CALLBACK={self.ansible_callback} exec ansible-playbook " + " ".join(
+            shlex.quote(arg) for arg in playbook_args
+        )
+        result = await self._run_remote(script, job, timeout=timeout, on_line=on_line, capture=False)
+        
+        parser.finish(result.returncode, "\n".join(stderr_tail))
+        self._update_job_progress(job, phase, parser)
+        return subprocess.CompletedProcess(result.args, result.returncode, "\n".join(parser.tail), "\n".join(stderr_tail))
+    
+    def _update_job_progress(self, job: Dict[str, Any], phase: str, parser: AnsibleOutputParser):
+        """Copy parser state into the job (only targets that changed) and publish the delta"""
+        changed = {}
+        for target in parser.dirty:
+            state = parser.targets[target]
+            job["progress"][target] = "failed" if state["state"] == "unreachable" else state["state"]
+            job["results"][target]["current_task"] = state["task"]
+            changed[target] = {"status": job["progress"][target], "current_task": state["task"]}
+        parser.dirty.clear()
+        
+        phases = job.setdefault("phase_progress", {})
+        previous = phases.get(phase)
+        phases[phase] = {
+            "current_task": parser.current_task,
+            "tasks_completed": parser.tasks_completed,
+            "tasks_total": parser.tasks_total
+        }
+        job["current_task"] = parser.current_task
+        job["tasks_completed"] = sum(p["tasks_completed"] for p in phases.values())
+        job["tasks_total"] = sum(p["tasks_total"] for p in phases.values())
+        job["estimated_time"] = parser.eta()
+        
+        if changed or phases[phase] != previous:
+            self.events.publish(job["job_id"], "progress", {
+                "phase": phase,
+                "targets": changed,
+                "current_task": job["current_task"],
+                "tasks_completed": job["tasks_completed"],
+                "tasks_total": job["tasks_total"],
+                "estimated_time": job["estimated_time"]
+            })
+        if parser.fresh:
+            self.events.publish(job["job_id"], "output", {"phase": phase, "lines": parser.fresh})
+            parser.fresh = []
     
     async def apply_patches(
         self,
         hosts: List[str],
         patch_type: str = "all",
         dry_run: bool = False,
-        schedule: Optional[str] = None
+        schedule: Optional[str] = None,
+        priority: str = "normal",
+        rollout: Any = None,
+        prefetch: bool = False
     ) -> str:
         """
         Apply patches to hosts.
@@ -309,15 +1721,105 @@ fi
             hosts: List of hostnames to patch
             patch_type: "all" or "security"
             dry_run: If True, only preview patches
-            schedule: ISO datetime string or None for immediate
+            schedule: ISO datetime, ISO 8601 repeating interval
+                ("R/<start>/<period>"), "window", or None for immediate
+            priority: "high", "normal" or "low" place in the job queue
+            rollout: True (or a dict overriding rollout_defaults) to patch
+                in adaptive waves instead of all targets at once
+            prefetch: download packages prefetch_lead seconds before a
+                scheduled run, so the run installs from the local cache
         
         Returns:
             job_id: Unique job identifier
+        
+        Raises:
+            JobQueueFullError: the job queue is saturated (immediate jobs only)
         """
-        job_id = str(uuid.uuid4())
+        if priority not in JobExecutor.PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        job = self._new_job(hosts, patch_type, dry_run)
+        job["priority"] = priority
+        if rollout:
+            job["rollout"] = dict(self.rollout_defaults, **(rollout if isinstance(rollout, dict) else {}))
+        if prefetch and (not schedule or dry_run):
+            raise ValueError("prefetch needs a scheduled, non dry-run job")
         
-        job = {
-            "job_id": job_id,
+        self._enqueue(job, schedule)
+        if prefetch:
+            job["prefetch_job_id"] = await self.prefetch_packages(
+                hosts, patch_type, schedule=self._prefetch_schedule(job), priority="low"
+            )
+            self.jobs.save(job)
+        return job["job_id"]
+    
+    async def prefetch_packages(
+        self,
+        hosts: List[str],
+        patch_type: str = "all",
+        schedule: Optional[str] = None,
+        priority: str = "low",
+        max_parallel: Optional[int] = None
+    ) -> str:
+        """
+        Download the packages a patch run would install, without installing them.
+        
+        A prefetch is a dry run that also fills each target's apt archive
+        cache; results carry the bytes staged per target. A patch run within
+        prefetch_max_age then skips the apt list refresh and installs from
+        that cache. Scheduled prefetches don't wait for a maintenance window.
+        
+        Args:
+            hosts: List of hostnames to prefetch for
+            patch_type: "all" or "security" (what the patch run will install)
+            schedule: as for apply_patches
+            priority: place in the job queue
+            max_parallel: targets downloading at once (prefetch_parallel if None)
+        
+        Returns:
+            job_id: Unique job identifier
+        """
+        if priority not in JobExecutor.PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        job = self._new_job(hosts, patch_type, True)
+        job.update({
+            "priority": priority,
+            "prefetch": True,
+            "max_parallel": max_parallel or self.prefetch_parallel,
+            "use_inventory_cache": False
+        })
+        self._enqueue(job, schedule)
+        return job["job_id"]
+    
+    def _prefetch_schedule(self, job: Dict[str, Any]) -> str:
+        """Schedule for a scheduled job's prefetch: prefetch_lead earlier, same recurrence"""
+        run_at = datetime.fromisoformat(job["scheduled_for"]) - timedelta(seconds=self.prefetch_lead)
+        run_at = max(run_at, datetime.now())
+        if job.get("recurrence"):
+            repeat, _, period = job["schedule"].split("/")
+            return f"{repeat}/{run_at.isoformat()}/{period}"
+        return run_at.isoformat()
+    
+    def _enqueue(self, job: Dict[str, Any], schedule: Optional[str]):
+        """Store a new job and either schedule it or queue it to run now"""
+        if schedule:
+            run_at, recurrence = self._parse_schedule(schedule)
+            job["status"] = PatchJobStatus.SCHEDULED.value
+            job["schedule"] = schedule
+            job["scheduled_for"] = run_at.isoformat()
+            job["recurrence"] = recurrence
+            self.jobs.add(job)
+            self.scheduler.add(job["job_id"], run_at)
+            self.scheduler.start()
+            self._audit_log("job_scheduled", job["job_id"], {"hosts": job["hosts"], "scheduled_for": job["scheduled_for"]})
+        else:
+            # Execute as soon as the executor has room (raises if the queue is full)
+            self._submit(job)
+            self.jobs.add(job)
+    
+    def _new_job(self, hosts: List[str], patch_type: str, dry_run: bool, created_by: str = "api") -> Dict[str, Any]:
+        """A fresh job record (not yet stored)"""
+        return {
+            "job_id": str(uuid.uuid4()),
             "hosts": hosts,
             "patch_type": patch_type,
             "dry_run": dry_run,
@@ -333,111 +1835,317 @@ fi
             "tasks_total": 0,
             "estimated_time": None,
             "error_category": None,
-            "created_by": "api",  # Could be extended to track user
+            "created_by": created_by,  # Could be extended to track user
             "created_at": datetime.now().isoformat()
         }
+    
+    def _parse_schedule(self, schedule: str):
+        """Parse a schedule -> (first run time, recurrence or None)
+        
+        Accepts an ISO datetime ("2026-11-01T02:00:00"), an ISO 8601
+        repeating interval ("R/2026-11-01T02:00:00/P1W", "R4/.../P1D"), or
+        "window" for the start of the next maintenance window.
+        """
+        if schedule == "window":
+            return self._next_window_start(datetime.now()), None
         
-        self.jobs[job_id] = job
+        recurrence = None
+        if schedule.startswith("R"):
+            repeat, start, period = schedule.split("/")
+            match = self.DURATION_RE.match(period)
+            if not match or not any(match.groupdict().values()):
+                raise ValueError(f"Invalid schedule interval: {period}")
+            interval = timedelta(**{unit: int(value) for unit, value in match.groupdict().items() if value})
+            recurrence = {
+                "interval_seconds": interval.total_seconds(),
+                "remaining": int(repeat[1:]) - 1 if repeat[1:] else None
+            }
+            schedule = start
         
-        # Execute immediately or schedule
-        if schedule:
-            # TODO: Implement scheduling
-            job["scheduled_for"] = schedule
-        else:
-            # Execute now (async)
-            asyncio.create_task(self._execute_patch_job(job_id))
+        run_at = datetime.fromisoformat(schedule)
+        if run_at.tzinfo is not None:
+            run_at = run_at.astimezone().replace(tzinfo=None)
+        return run_at, recurrence
+    
+    def _in_window(self, when: datetime) -> bool:
+        if not self.maintenance_windows:
+            return True
+        for window in self.maintenance_windows:
+            hour, minute = (int(part) for part in window["start"].split(":"))
+            # A window that started yesterday may still be open
+            for days_back in (0, 1):
+                start = (when - timedelta(days=days_back)).replace(hour=hour, minute=minute, second=0, microsecond=0)
+                if window.get("weekdays") is not None and start.weekday() not in window["weekdays"]:
+                    continue
+                if start <= when < start + timedelta(minutes=window["duration_minutes"]):
+                    return True
+        return False
+    
+    def _next_window_start(self, after: datetime) -> datetime:
+        """after itself if it falls in a maintenance window, else the next window start"""
+        if self._in_window(after):
+            return after
+        starts = []
+        for window in self.maintenance_windows:
+            hour, minute = (int(part) for part in window["start"].split(":"))
+            for days_ahead in range(8):
+                start = (after + timedelta(days=days_ahead)).replace(hour=hour, minute=minute, second=0, microsecond=0)
+                if start > after and (window.get("weekdays") is None or start.weekday() in window["weekdays"]):
+                    starts.append(start)
+                    break
+        return min(starts) if starts else after
+    
+    def _dispatch_scheduled(self, job_ids: List[str]):
+        """Start scheduled jobs that fell due, merging compatible ones into one run"""
+        self._sync_asset_index()  # before any target keys are computed
+        now = datetime.now()
+        groups = {}
+        for job_id in job_ids:
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] != PatchJobStatus.SCHEDULED.value:
+                continue
+            if not job["dry_run"] and not self._in_window(now):
+                # Due (or caught up after a restart) outside a maintenance window;
+                # dry runs only read package state, so they aren't held back
+                run_at = self._next_window_start(now)
+                job["scheduled_for"] = run_at.isoformat()
+                self.jobs.save(job)
+                self.scheduler.add(job_id, run_at)
+                continue
+            rollout = json.dumps(job.get("rollout"), sort_keys=True)
+            groups.setdefault((job["patch_type"], job["dry_run"], job.get("prefetch", False), rollout), []).append(job_id)
+        
+        for group in groups.values():
+            members = [self.jobs[job_id] for job_id in group]
+            hosts = [host for member in members for host in member["hosts"]]
+            priority = min((member.get("priority", "normal") for member in members), key=JobExecutor.PRIORITIES.get)
+            if len(group) == 1:
+                run = lambda job_id=group[0]: self._execute_patch_job(job_id)
+            else:
+                run = lambda group=group: self._execute_merged_jobs(group)
+            try:
+                self.executor.submit(group[0], run, [self._target_key(host) for host in hosts], self._target_nodes(hosts), priority)
+            except JobQueueFullError:
+                # Saturated: try again later rather than drop the occurrence
+                run_at = datetime.now() + timedelta(seconds=self.queue_defer_seconds)
+                for member in members:
+                    # The next occurrence is only queued once this one is submitted
+                    member.setdefault("occurrence_at", member["scheduled_for"])
+                    member["scheduled_for"] = run_at.isoformat()
+                    self.jobs.save(member)
+                    self.scheduler.add(member["job_id"], run_at)
+                self._audit_log("job_deferred", group[0], {"jobs": group, "until": run_at.isoformat(), "reason": "queue full"})
+                continue
+            for member in members:
+                self._schedule_next_occurrence(member)
+                member["status"] = PatchJobStatus.PENDING.value
+                if len(group) > 1:
+                    member["merged_group"] = group  # queued as one executor entry under group[0]
+                self.jobs.save(member)
+    
+    def _submit(self, job: Dict[str, Any]):
+        """Hand a job to the executor; raises JobQueueFullError when saturated"""
+        # Lock keys must come from the current index: the same asset requested
+        # by name and by IP has to map to one key
+        self._sync_asset_index()
+        self.executor.submit(
+            job["job_id"],
+            lambda: self._execute_patch_job(job["job_id"]),
+            [self._target_key(host) for host in job["hosts"]],
+            self._target_nodes(job["hosts"]),
+            job.get("priority", "normal")
+        )
+    
+    def _target_nodes(self, hostnames: List[str]) -> List[str]:
+        """Proxmox nodes a set of requested hosts live on
+        
+        Placement comes from the cluster topology once it has been loaded
+        (it follows migrations, as container routing does), else from
+        discovery.
+        """
+        self._sync_asset_index()
+        nodes = set()
+        for hostname in hostnames:
+            asset = self.asset_index.lookup(hostname)
+            if asset is None:
+                continue
+            vmid = asset.get("vmid")
+            guest = self.topology.guests.get(int(vmid)) if str(vmid).isdigit() else None
+            node = guest["node"] if guest and guest.get("node") else asset.get("host")
+            if node:
+                nodes.add(node)
+        return sorted(nodes)
+    
+    def _schedule_next_occurrence(self, job: Dict[str, Any]):
+        """Queue the next run of a recurring job as a new scheduled job"""
+        recurrence = job.get("recurrence")
+        if not recurrence or recurrence["remaining"] == 0:
+            return
+        interval = timedelta(seconds=recurrence["interval_seconds"])
+        # Counted from the slot this occurrence was scheduled for, not from a queue-full deferral
+        run_at = datetime.fromisoformat(job.get("occurrence_at") or job["scheduled_for"]) + interval
+        while run_at <= datetime.now():
+            run_at += interval  # don't replay occurrences missed while down
+        
+        next_job = self._new_job(job["hosts"], job["patch_type"], job["dry_run"], created_by=job["created_by"])
+        next_job.update({
+            "status": PatchJobStatus.SCHEDULED.value,
+            "priority": job.get("priority", "normal"),
+            "rollout": job.get("rollout"),
+            "prefetch": job.get("prefetch", False),
+            "max_parallel": job.get("max_parallel"),
+            "use_inventory_cache": job.get("use_inventory_cache", True),
+            "schedule": job["schedule"],
+            "scheduled_for": run_at.isoformat(),
+            "recurrence": {
+                "interval_seconds": recurrence["interval_seconds"],
+                "remaining": None if recurrence["remaining"] is None else recurrence["remaining"] - 1
+            }
+        })
+        self.jobs.add(next_job)
+        self.scheduler.add(next_job["job_id"], run_at)
+    
+    def _target_key(self, hostname: str) -> str:
+        """Key a requested host ends up under in job progress/results"""
+        asset = self.asset_index.lookup(hostname)
+        if asset is None:
+            return hostname
+        if asset.get("type") == "ct":
+            return asset.get("name")
+        return asset.get("ip") or hostname
+    
+    async def _execute_merged_jobs(self, job_ids: List[str]):
+        """Run several due scheduled jobs as one playbook invocation and fan the results back out"""
+        members = [self.jobs[job_id] for job_id in job_ids]
+        hosts = list(dict.fromkeys(host for member in members for host in member["hosts"]))
+        merged = self._new_job(hosts, members[0]["patch_type"], members[0]["dry_run"], created_by="scheduler")
+        merged["merged_from"] = job_ids
+        for field in ("rollout", "prefetch", "max_parallel", "use_inventory_cache"):
+            if field in members[0]:
+                merged[field] = members[0][field]
+        self.jobs.add(merged)
+        
+        for member in members:
+            member["status"] = PatchJobStatus.RUNNING.value
+            member["started_at"] = datetime.now().isoformat()
+            member["merged_into"] = merged["job_id"]
+            self.jobs.save(member)
+        self._audit_log("jobs_merged", merged["job_id"], {"jobs": job_ids, "hosts": hosts})
         
-        return job_id
+        try:
+            await self._execute_patch_job(merged["job_id"])
+        finally:
+            merged = self.jobs[merged["job_id"]]
+            for member in members:
+                for key in (self._target_key(host) for host in member["hosts"]):
+                    if key in merged["progress"]:
+                        member["progress"][key] = merged["progress"][key]
+                    if key in merged["results"]:
+                        member["results"][key] = merged["results"][key]
+                for field in ("error", "error_category", "retry_count"):
+                    if merged.get(field) is not None:
+                        member[field] = merged[field]
+                member["status"] = merged["status"] if merged["status"] in (
+                    PatchJobStatus.COMPLETED.value, PatchJobStatus.FAILED.value
+                ) else PatchJobStatus.FAILED.value
+                member["completed_at"] = merged.get("completed_at") or datetime.now().isoformat()
+                self.jobs.finish(member)
+    
+    def on_discovery_update(self, updated: Optional[Dict[str, Any]] = None, removed: Optional[List[str]] = None):
+        """Apply a discovery cache delta to the asset index
+        
+        Discovery calls this with the entries it added/changed and the keys it
+        dropped. Once it does, the index is no longer diffed against the whole
+        cache when a job is admitted.
+        """
+        self._asset_index_hooked = True
+        for key in removed or []:
+            self.asset_index.remove(key)
+        for key, asset in (updated or {}).items():
+            self.asset_index.update(key, asset)
+    
+    def _sync_asset_index(self):
+        """Catch the asset index up with discovery unless discovery pushes updates itself"""
+        if not self._asset_index_hooked:
+            from main import discovery_cache
+            self.asset_index.sync(discovery_cache)
+    
+    def _resolve_targets(self, hostnames: List[str]):
+        """Resolve a job's requested hosts to discovery assets in one pass"""
+        self._sync_asset_index()
+        return self.asset_index.resolve(hostnames)
     
     async def _execute_patch_job(self, job_id: str):
         """Execute patching job with retry logic"""
         job = self.jobs[job_id]
         job["status"] = PatchJobStatus.RUNNING.value
         job["started_at"] = datetime.now().isoformat()
+        self.jobs.save(job)
         
         self._audit_log("job_started", job_id, {"hosts": job["hosts"], "patch_type": job["patch_type"]})
         
         try:
             # Get asset info to determine if containers or hosts
-            from main import discovery_cache
+            resolved, unresolved = self._resolve_targets(job["hosts"])
+            if unresolved:
+                job["unresolved_hosts"] = unresolved
             
             containers = []
             host_ips = []
+            seen = set()
             
-            for hostname in job["hosts"]:
-                # Find asset in discovery cache
-                asset = None
-                for asset_data in discovery_cache.values():
-                    if isinstance(asset_data, dict):
-                        if asset_data.get("name") == hostname:
-                            asset = asset_data
-                            break
-                
-                if asset:
-                    if asset.get("type") == "ct":
-                        node_host = asset.get("host", "pve-scratchy")
-                        # Map node hostname to IP address
-                        node_ip_map = {
-                            "pve-scratchy": "10.16.1.22",
-                            "pve-itchy": "10.16.1.8"
-                        }
-                        node_ip = node_ip_map.get(node_host, "10.16.1.22")
-                        containers.append({
-                            "name": asset.get("name"),
-                            "ct_id": asset.get("vmid"),
-                            "ip": asset.get("ip"),
-                            "node": node_host,
-                            "node_ip": node_ip
-                        })
-                    else:
-                        host_ips.append(asset.get("ip") or hostname)
+            for hostname, asset in resolved.items():
+                if id(asset) in seen:
+                    continue  # same asset requested by name and by vmid/IP
+                seen.add(id(asset))
+                if asset.get("type") == "ct":
+                    # Owning node is looked up in the cluster topology per attempt
+                    containers.append({
+                        "name": asset.get("name"),
+                        "ct_id": asset.get("vmid"),
+                        "ip": asset.get("ip"),
+                        "node": asset.get("host")
+                    })
+                else:
+                    host_ips.append(asset.get("ip") or hostname)
             
-            # Execute appropriate playbook with retry
-            success = False
-            last_error = None
+            if job["dry_run"] and job.get("use_inventory_cache", True):
+                cached = self._serve_from_inventory(job, [c["name"] for c in containers] + host_ips)
+                containers = [container for container in containers if container["name"] not in cached]
+                host_ips = [ip for ip in host_ips if ip not in cached]
             
-            for attempt in range(self.max_retries):
-                if attempt > 0:
-                    job["status"] = PatchJobStatus.RETRYING.value
-                    job["retry_count"] = attempt
-                    self._audit_log("job_retry", job_id, {"attempt": attempt, "error": str(last_error)})
-                    await asyncio.sleep(self.retry_delay * attempt)  # Exponential backoff
-                
-                try:
-                    if containers:
-                        await self._patch_containers(job, containers)
-                    
-                    if host_ips:
-                        await self._patch_hosts(job, host_ips)
-                    
-                    success = True
-                    break
-                    
-                except Exception as e:
-                    last_error = e
-                    error_cat = self._categorize_error(str(e))
-                    job["error_category"] = error_cat.value
-                    
-                    # Don't retry permission errors
-                    if error_cat == ErrorCategory.PERMISSION:
-                        break
-                    
-                    if attempt < self.max_retries - 1:
-                        continue
+            if self.apt_proxy:
+                job["apt_proxy"] = self.apt_proxy
+            
+            # Containers and hosts are independent: run both phases at once,
+            # each retrying only its own targets that failed
+            phases = {}
+            if containers:
+                phases["containers"] = (self._patch_containers, {container["name"]: container for container in containers})
+            if host_ips:
+                phases["hosts"] = (self._patch_hosts, {ip: ip for ip in host_ips})
+            outcomes = await asyncio.gather(*(
+                self._run_job_phase(job, phase, phase_fn, targets)
+                for phase, (phase_fn, targets) in phases.items()
+            ))
+            failed = [target for phase_failed in outcomes for target in phase_failed]
             
-            if success:
+            if job.get("apt_proxy"):
+                clients = {container["ip"]: container["name"] for container in containers if container.get("ip")}
+                clients.update({ip: ip for ip in host_ips})
+                await self._record_package_cache(job, clients)
+            
+            if not failed:
                 job["status"] = PatchJobStatus.COMPLETED.value
                 job["completed_at"] = datetime.now().isoformat()
                 self._audit_log("job_completed", job_id, {"hosts": job["hosts"]})
-                
-                # Mark that patch status should be refreshed
-                # The refresh will be triggered via API endpoint to avoid circular imports
-                job["needs_status_refresh"] = True
             else:
+                categories = [job["results"][name].get("error_category") for name in failed]
                 job["status"] = PatchJobStatus.FAILED.value
-                job["error"] = str(last_error)
+                job["error"] = f"{len(failed)} of {len(job['results'])} target(s) failed: " + ", ".join(failed[:10])
+                job["error_category"] = max(set(categories), key=categories.count)
                 job["completed_at"] = datetime.now().isoformat()
-                self._audit_log("job_failed", job_id, {"error": str(last_error), "retries": job["retry_count"]})
+                self._audit_log("job_failed", job_id, {"error": job["error"], "failed": failed, "retries": job["retry_count"]})
             
         except Exception as e:
             job["status"] = PatchJobStatus.FAILED.value
@@ -445,340 +2153,803 @@ fi
             job["error_category"] = ErrorCategory.UNKNOWN.value
             job["completed_at"] = datetime.now().isoformat()
             self._audit_log("job_failed", job_id, {"error": str(e)})
+        
+        finally:
+            try:
+                self._refresh_compliance(job)
+            except Exception as e:
+                job["needs_status_refresh"] = True  # fall back to a full refresh
+                print(f"⚠️ Compliance update for job {job_id} failed: {e}")
+            self.jobs.finish(job)
     
-    async def _patch_containers(self, job: Dict[str, Any], containers: List[Dict[str, Any]]):
-        """Patch LXC containers with enhanced output parsing"""
-        import tempfile
-        import os
+    async def _fetch_package_cache_log(self, since: float) -> List[str]:
+        """Proxy transfer log lines from `since` on, from the log file or the proxy host"""
+        if self.apt_cache_log:
+            with open(self.apt_cache_log) as f:
+                return f.readlines()
+        host = self.apt_cache_host or f"root@{urlsplit(self.apt_proxy).hostname}"
+        result = await SSHTransport(self._run_command, self.ssh_pool, host).run(
+            f"awk -F'|' '$1 >= {int(since)}' {shlex.quote(self.apt_cache_remote_log)}",
+            timeout=30
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or f"reading the cache log exited with {result.returncode}")
+        return result.stdout.splitlines()
+    
+    async def _record_package_cache(self, job: Dict[str, Any], clients: Dict[str, str]):
+        """Attach the proxy's hit/miss and bytes saved for this job's targets to its results
         
-        # Initialize progress for all containers
-        for container in containers:
-            job["progress"][container["name"]] = "running"
-            job["results"][container["name"]] = {"success": False, "output": "", "packages_upgraded": 0}
+        clients maps target IPs (as the proxy sees them) to result keys.
+        Stats are informational: a log that can't be read doesn't fail the job.
+        """
+        since = int(datetime.fromisoformat(job["started_at"]).timestamp())  # the log has whole seconds
+        try:
+            lines = await self._fetch_package_cache_log(since)
+        except Exception as e:
+            print(f"⚠️ Package cache stats for job {job['job_id']} unavailable: {e}")
+            job["package_cache"] = {"proxy": job["apt_proxy"], "error": str(e)}
+            return
+        stats = PackageCacheStats.summarize(lines, since, time.time(), list(clients))
+        for client, client_stats in stats.pop("clients").items():
+            if clients[client] in job["results"]:
+                job["results"][clients[client]]["package_cache"] = client_stats
+        job["package_cache"] = dict(stats, proxy=job["apt_proxy"])
+        self.events.publish(job["job_id"], "package_cache", job["package_cache"])
+    
+    def _serve_from_inventory(self, job: Dict[str, Any], targets: List[str]) -> List[str]:
+        """Answer a dry run from the inventory cache where possible; returns the targets served"""
+        served = []
+        for target in targets:
+            entry = self.inventory.get(target)
+            if entry is None:
+                continue
+            job["progress"][target] = "completed"
+            job["results"][target] = {
+                "success": True,
+                "output": "",
+                "packages_available": entry["packages_available"],
+                "packages_upgraded": 0,
+                "security_updates": entry["security_updates"],
+                "packages": entry["packages"],
+                "security_packages": entry["security_packages"],
+                "upgraded_packages": [],
+                "reboot_required": entry["reboot_required"],
+                "fingerprint": entry["fingerprint"],
+                "probed": True,
+                "cached": True,
+                "cache_age": round(time.time() - entry["fetched_at"], 1)
+            }
+            served.append(target)
+        if served:
+            job["completed_targets"] = sorted(set(job.get("completed_targets", [])) | set(served))
+            self._audit_log("inventory_cache_hit", job["job_id"], {"targets": served})
+        return served
+    
+    def _update_inventory(self, job: Dict[str, Any], targets: List[str]):
+        """Cache what a dry run probed; forget what a real run touched"""
+        for target in targets:
+            result = job["results"].get(target, {})
+            if result.get("cached"):
+                continue
+            if job["dry_run"]:
+                if result.get("success") and result.get("probed"):
+                    self.inventory.record(target, result)
+            else:
+                self.inventory.invalidate(target)
+    
+    def _update_prefetched(self, job: Dict[str, Any], targets: List[str]):
+        """Note what a prefetch staged; a real run consumes it"""
+        if job.get("prefetch"):
+            for target in targets:
+                result = job["results"][target]
+                if result["success"]:
+                    self.prefetched[target] = {
+                        "job_id": job["job_id"],
+                        "at": time.time(),
+                        "staged_bytes": result.get("staged_bytes", 0),
+                        "cache_bytes": result.get("cache_bytes", 0)
+                    }
+            job["staged_bytes"] = sum(result.get("staged_bytes") or 0 for result in job["results"].values())
+        elif not job["dry_run"]:
+            for target in targets:
+                if target in self.prefetched and job["results"][target]["success"]:
+                    job["results"][target]["prefetched_by"] = self.prefetched.pop(target)["job_id"]
+    
+    def get_inventory(self, targets: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Cached upgradable packages per target, for compliance views
         
-        # Write containers JSON to a simple text file that playbook can read
-        # Use base64 encoding to avoid shell escaping issues
-        container_list_file = "/tmp/ansible_container_list.txt"
-        containers_json = json.dumps(containers)
-        containers_b64 = base64.b64encode(containers_json.encode('utf-8')).decode('utf-8')
-        
-        # Write file using base64 decode via bash (more reliable than Python stdin)
-        write_cmd = [
-            "/usr/bin/ssh", "-o", "ConnectTimeout=10", "-o", "BatchMode=yes",
-            self.ansible_host,
-            f"qm guest exec {self.ansible_vm} -- bash -c 'echo {containers_b64} | base64 -d > {container_list_file} && echo OK'"
-        ]
+        Only entries younger than the cache TTL are returned; nothing is
+        probed.
+        """
+        entries = self.inventory.snapshot(targets)
+        return {
+            "targets": entries,
+            "packages_available": sum(entry["packages_available"] for entry in entries.values()),
+            "security_updates": sum(entry["security_updates"] for entry in entries.values()),
+            "ttl": self.inventory.ttl,
+            "hits": self.inventory.hits,
+            "misses": self.inventory.misses
+        }
+    
+    def _refresh_compliance(self, job: Dict[str, Any]):
+        """Push what this job learned about its targets into the discovery cache
         
-        write_result = subprocess.run(
-            write_cmd,
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
+        Each target's asset gets a "patching" entry built from the counts the
+        playbook already collected: as probed for dry runs, and what should
+        be left after a successful real run (marked as an estimate). Targets
+        that were actually patched get a low-priority dry run re-probe after
+        reprobe_delay seconds to confirm the estimate. A target whose probe
+        never completed keeps its previous entry, flagged stale. Only targets
+        missing from the cache leave job["needs_status_refresh"] set.
+        """
+        updated, missing, patched, stale = {}, [], [], []
+        for target, result in job["results"].items():
+            asset = self.asset_index.lookup(target)
+            if not result.get("probed"):
+                # Its counts are parser defaults, not what's on the target
+                if asset is not None and asset.get("patching"):
+                    asset["patching"]["stale"] = True
+                    stale.append(target)
+                continue
+            if asset is None:
+                missing.append(target)
+                continue
+            available, security = result["packages_available"], result["security_updates"]
+            estimate = not job["dry_run"] and result.get("success")
+            if estimate:
+                patched.append(target)
+                if job["patch_type"] == "security":
+                    available, security = max(available - result["packages_upgraded"], 0), 0
+                else:
+                    available, security = 0, 0
+            # Discovery shares its asset dicts with the index, so this updates the cache entry
+            asset["patching"] = updated[target] = {
+                "packages_available": available,
+                "security_updates": security,
+                "reboot_required": result.get("reboot_required", False),
+                "source": "estimate" if estimate else "probe",
+                "last_job_id": job["job_id"],
+                "last_job_success": bool(result.get("success")),
+                "checked_at": datetime.now().isoformat()
+            }
         
-        # Parse qm guest exec output (it returns JSON)
-        write_stdout = write_result.stdout
-        actual_output = ""
-        if write_stdout.strip().startswith('{'):
-            try:
-                json_output = json.loads(write_stdout)
-                actual_output = json_output.get('out-data', '')
-                if 'err-data' in json_output and json_output.get('err-data'):
-                    write_result.stderr = json_output.get('err-data', write_result.stderr)
-                # Check exitcode from JSON
-                if json_output.get('exitcode', 0) != 0:
-                    write_result.returncode = json_output.get('exitcode', 1)
-            except:
-                actual_output = write_stdout
-        
-        # Verify file was written and contains valid JSON
-        verify_cmd = [
-            "/usr/bin/ssh", "-o", "ConnectTimeout=10", "-o", "BatchMode=yes",
-            self.ansible_host,
-            f"qm guest exec {self.ansible_vm} -- bash -c 'test -f {container_list_file} && python3 -c \"import json; json.load(open(\\\"{container_list_file}\\\")); print(\\\"OK\\\")\" || echo FAIL'"
-        ]
+        job["needs_status_refresh"] = bool(missing)
+        refresh = job["compliance_refresh"] = {"updated": sorted(updated), "missing": missing, "stale": stale}
+        if updated:
+            self.events.publish(job["job_id"], "compliance", updated)
+        if patched and job.get("created_by") != "reprobe":
+            refresh["reprobe_job_id"] = self._schedule_reprobe(patched)
+    
+    def _schedule_reprobe(self, targets: List[str]) -> str:
+        """Queue a low-priority dry run of just these targets"""
+        run_at = datetime.now() + timedelta(seconds=self.reprobe_delay)
+        job = self._new_job(targets, "all", True, created_by="reprobe")
+        job.update({
+            "status": PatchJobStatus.SCHEDULED.value,
+            "priority": "low",
+            "use_inventory_cache": False,
+            "schedule": run_at.isoformat(),
+            "scheduled_for": run_at.isoformat()
+        })
+        self.jobs.add(job)
+        self.scheduler.add(job["job_id"], run_at)
+        self.scheduler.start()
+        return job["job_id"]
+    
+    async def _run_job_phase(self, job: Dict[str, Any], phase: str, phase_fn, targets: Dict[str, Any]) -> List[str]:
+        """Run one phase of a job under its own timeout; returns its failed targets
         
-        verify_result = subprocess.run(
-            verify_cmd,
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
+        Progress and outcome are kept in job["phases"][phase]. A phase that
+        times out or blows up fails only its own unfinished targets.
+        """
+        state = job.setdefault("phases", {})[phase] = {
+            "status": PatchJobStatus.RUNNING.value,
+            "targets": list(targets),
+            "started_at": datetime.now().isoformat(),
+            "retry_count": 0
+        }
+        self.jobs.save(job)
+        timeout = self.phase_timeouts.get(phase)
+        try:
+            run = self._run_rollout if job.get("rollout") else self._run_with_checkpoints
+            failed = await asyncio.wait_for(run(job, phase, phase_fn, targets), timeout=timeout)
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                error, category = f"{phase} phase timed out after {timeout}s", ErrorCategory.TIMEOUT
+            else:
+                error, category = str(e) or type(e).__name__, ErrorCategory.UNKNOWN
+            done = set(job.get("completed_targets", []))
+            failed = [target for target in targets if target not in done]
+            for target in failed:
+                job["progress"][target] = "failed"
+                job["results"][target] = dict(job["results"].get(target, {}), success=False, error=error, error_category=category.value)
+            state["error"] = error
         
-        verify_output = verify_result.stdout
-        if verify_output.strip().startswith('{'):
-            try:
-                json_output = json.loads(verify_output)
-                verify_output = json_output.get('out-data', verify_output)
-            except:
-                pass
+        state["status"] = PatchJobStatus.FAILED.value if failed else PatchJobStatus.COMPLETED.value
+        state["failed"] = failed
+        state["completed_at"] = datetime.now().isoformat()
+        self._audit_log(f"phase_{state['status']}", job["job_id"], {"phase": phase, "failed": failed})
+        self.jobs.save(job)
+        return failed
+    
+    async def _run_rollout(self, job: Dict[str, Any], phase: str, phase_fn, targets: Dict[str, Any]) -> List[str]:
+        """Patch a phase's targets in waves sized AIMD style (see rollout_defaults)
         
-        if write_result.returncode != 0 or "OK" not in verify_output:
-            error_msg = write_result.stderr if write_result.stderr else actual_output
-            raise Exception(f"Failed to write container list file: {error_msg}")
+        Each wave goes through _run_with_checkpoints, so a wave's failures
+        are what is left after retries, categorised. Targets left when the
+        rollout halts are failed without being touched.
+        """
+        config = job["rollout"]
+        state = job["phases"][phase]["rollout"] = {"window": config["canary"], "waves": [], "halted": None}
+        done = set(job.get("completed_targets", []))
+        remaining = [target for target in targets if target not in done]
+        failed = []
+        category_failures = {}
+        attempted = 0
+        baseline = None
         
-        try:
-            # Execute container patching playbook (simplified version that reads from file)
-            cmd = [
-                "/usr/bin/ssh", "-o", "ConnectTimeout=10", "-o", "BatchMode=yes",
-                self.ansible_host,
-                f"qm guest exec {self.ansible_vm} -- ansible-playbook",
-                f"{self.playbook_path}/patch-containers-simple.yml",
-                "-e", f"patch_type={job['patch_type']}",
-                "-e", f"dry_run_mode={str(job['dry_run']).lower()}"
-            ]
-            
-            start_time = time.time()
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=1800  # 30 minutes
-            )
-            elapsed_time = time.time() - start_time
+        while remaining:
+            wave, remaining = remaining[:state["window"]], remaining[state["window"]:]
+            # Hosts share one ansible run per wave: give it a fork per host
+            wave_fn = functools.partial(phase_fn, forks=len(wave)) if phase == "hosts" else phase_fn
+            start = time.time()
+            wave_failed = await self._run_with_checkpoints(job, phase, wave_fn, {target: targets[target] for target in wave})
+            elapsed = time.time() - start
             
-            # Parse output for package counts
-            parsed_output = self._parse_container_output(result.stdout, containers)
+            attempted += len(wave)
+            failed += wave_failed
+            for target in wave_failed:
+                category = job["results"][target].get("error_category")
+                category_failures[category] = category_failures.get(category, 0) + 1
+            state["waves"].append({"size": len(wave), "failed": len(wave_failed), "elapsed": round(elapsed, 1)})
             
-            job["output"].append({
-                "type": "containers",
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "returncode": result.returncode,
-                "parsed": parsed_output,
-                "elapsed_time": elapsed_time
-            })
+            systemic = [category for category, limit in config["systemic"].items() if category_failures.get(category, 0) >= limit]
+            failure_rate = len(failed) / attempted
+            if systemic:
+                state["halted"] = f"systemic {', '.join(systemic)} failures"
+            elif len(state["waves"]) == 1 and wave_failed:
+                state["halted"] = "canary failed"
+            elif failure_rate > config["failure_threshold"]:
+                state["halted"] = f"failure rate {failure_rate:.0%} above {config['failure_threshold']:.0%}"
+            if state["halted"] and remaining:
+                category = max(category_failures, key=category_failures.get)
+                for target in remaining:
+                    job["progress"][target] = "failed"
+                    job["results"][target] = dict(
+                        job["results"].get(target, {}),
+                        success=False,
+                        error=f"Not patched: rollout halted ({state['halted']})",
+                        error_category=category
+                    )
+                failed += remaining
+                self._audit_log("rollout_halted", job["job_id"], {"phase": phase, "reason": state["halted"], "skipped": remaining})
+                break
             
-            # Update progress based on parsed output
-            if result.returncode == 0:
-                for container in containers:
-                    container_result = parsed_output.get(container["name"], {})
-                    job["progress"][container["name"]] = "completed"
-                    job["results"][container["name"]] = {
-                        "success": True,
-                        "output": result.stdout[-1000:] if result.stdout else "",
-                        "packages_upgraded": container_result.get("packages_upgraded", 0),
-                        "security_updates": container_result.get("security_updates", 0)
-                    }
+            # Additive increase after a clean, normal-speed wave; halve otherwise
+            if baseline is None:
+                baseline = elapsed
+                window = config["initial"]
+            elif wave_failed or elapsed > config["slow_factor"] * baseline:
+                window = max(1, state["window"] // 2)
             else:
-                # Parse which containers failed
-                failed_containers = self._parse_failed_containers(result.stdout, result.stderr, containers)
-                for container in containers:
-                    if container["name"] in failed_containers:
-                        job["progress"][container["name"]] = "failed"
-                        job["results"][container["name"]] = {
-                            "success": False,
-                            "output": result.stderr[-1000:] if result.stderr else "",
-                            "error": failed_containers[container["name"]]
-                        }
-                    else:
-                        job["progress"][container["name"]] = "completed"
-                        job["results"][container["name"]] = {
-                            "success": True,
-                            "output": result.stdout[-1000:] if result.stdout else ""
-                        }
+                window = min(state["window"] + config["increase"], config["max_window"])
+            state["window"] = window
+            self.jobs.save(job)
         
-        finally:
-            # Cleanup: Remove container list file from VM
-            cleanup_cmd = [
-                "/usr/bin/ssh", "-o", "ConnectTimeout=10", "-o", "BatchMode=yes",
-                self.ansible_host,
-                f"qm guest exec {self.ansible_vm} -- bash -c 'rm -f {container_list_file}'"
-            ]
-            subprocess.run(cleanup_cmd, capture_output=True, timeout=5)
-    
-    def _parse_container_output(self, stdout: str, containers: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
-        """Parse container patching output"""
-        parsed = {}
+        return failed
+    
+    async def _run_with_checkpoints(self, job: Dict[str, Any], phase: str, phase_fn, targets_by_name: Dict[str, Any]) -> List[str]:
+        """Patch all targets of a phase, then retry only the ones that failed
         
-        for container in containers:
-            container_name = container["name"]
-            container_data = {
-                "packages_upgraded": 0,
-                "security_updates": 0,
-                "status": "unknown"
-            }
+        Completed targets are checkpointed in job["completed_targets"] and
+        never rerun. Each failed target is retried under the retry policy of
+        its error category (capped by host_retry_budgets), with backoff from
+        its own attempt count. Returns the targets that still failed at the end.
+        """
+        targets = list(targets_by_name)
+        phase_state = job["phases"][phase]
+        attempts = job.setdefault("attempts", {})
+        next_attempt_at = {}
+        completed = set(job.get("completed_targets", []))
+        pending = [target for target in targets if target not in completed]
+        waiting = set()  # failed targets sitting out their backoff
+        round_number = 0
+        
+        while pending:
+            if round_number > 0:
+                phase_state["status"] = PatchJobStatus.RETRYING.value
+                phase_state["retry_count"] = round_number
+                job["status"] = PatchJobStatus.RETRYING.value
+                job["retry_count"] = max(state.get("retry_count", 0) for state in job["phases"].values())
+                self.jobs.save(job)
+                self._audit_log("job_retry", job["job_id"], {
+                    "phase": phase,
+                    "attempt": round_number,
+                    "targets": pending,
+                    "errors": {target: job["results"][target].get("error") for target in pending}
+                })
+            
+            for target in pending:
+                attempts[target] = attempts.get(target, 0) + 1
+            
+            await self._run_phase(job, phase_fn, [targets_by_name[target] for target in pending], pending)
             
-            # Look for container-specific output
-            container_lines = [line for line in stdout.split('\n') if container_name in line or str(container.get("ct_id")) in line]
+            # Checkpoint what is done and categorise what isn't
+            failed = []
+            for target in pending:
+                if job["progress"].get(target) == "completed":
+                    completed.add(target)
+                else:
+                    failed.append(target)
+            categories = self.error_classifier.classify_all({target: job["results"][target].get("error") or "" for target in failed})
+            for target in failed:
+                job["results"][target]["error_category"] = categories[target].value
+                job["results"][target]["attempts"] = attempts[target]
+            # The other phase checkpoints into the same list concurrently
+            job["completed_targets"] = sorted(completed.union(job.get("completed_targets", [])))
+            self.jobs.save(job)
             
-            # Try to extract package counts
-            for line in container_lines:
-                if 'upgraded' in line.lower() or 'packages' in line.lower():
-                    numbers = re.findall(r'\d+', line)
-                    if numbers:
-                        container_data["packages_upgraded"] = int(numbers[0])
+            now = time.time()
+            for target in failed:
+                policy = self.retry_policies.get(job["results"][target]["error_category"], {"max_attempts": 1})
+                budget = min(policy.get("max_attempts", 1), self.host_retry_budgets.get(target, policy.get("max_attempts", 1)))
+                if attempts[target] >= budget:
+                    continue
+                next_attempt_at[target] = now + self._retry_delay(policy, attempts[target])
+                waiting.add(target)
+            if not waiting:
+                break
             
-            parsed[container_name] = container_data
+            # Sleep until the earliest target comes off backoff, then retry every target that has
+            earliest = min(next_attempt_at[target] for target in waiting)
+            await asyncio.sleep(max(earliest - time.time(), 0))
+            pending = [target for target in targets if target in waiting and next_attempt_at[target] <= earliest]
+            waiting.difference_update(pending)
+            round_number += 1
         
-        return parsed
+        return [target for target in targets if target not in completed]
+    
+    @staticmethod
+    def _retry_delay(policy: Dict[str, Any], attempt: int) -> float:
+        """Seconds to wait before retry number `attempt` under a retry policy"""
+        base = policy.get("base_delay", 5)
+        backoff = policy.get("backoff", "exponential")
+        if backoff == "constant":
+            delay = base
+        elif backoff == "linear":
+            delay = base * attempt
+        else:
+            delay = base * 2 ** (attempt - 1)
+        return min(delay, policy.get("max_delay", delay))
+    
+    async def _run_phase(self, job: Dict[str, Any], phase_fn, targets: List[Any], names: List[str]):
+        """Run one patch phase; a failure of the run itself fails each of its targets"""
+        try:
+            await phase_fn(job, targets)
+        except Exception as e:
+            for name in names:
+                job["progress"][name] = "failed"
+                job["results"][name] = dict(job["results"].get(name, {}), success=False, error=str(e) or type(e).__name__)
+    
+    async def _fetch_topology(self) -> Dict[str, Any]:
+        """Raw cluster status and guest list, from pvesh or the stand-in file"""
+        if self.topology_file:
+            with open(self.topology_file) as f:
+                return json.load(f)
+        # ansible_host is a cluster node: ask it directly, not via the Ansible VM
+        node = SSHTransport(self._run_command, self.ssh_pool, self.ansible_host)
+        result = await node.run(
+            "pvesh get /cluster/status --output-format json && echo && "
+            "pvesh get /cluster/resources --type vm --output-format json",
+            timeout=20
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or f"pvesh exited with {result.returncode}")
+        status, resources = [json.loads(part) for part in result.stdout.strip().split("\n", 1)]
+        return {"status": status, "resources": resources}
     
-    def _parse_failed_containers(self, stdout: str, stderr: str, containers: List[Dict[str, Any]]) -> Dict[str, str]:
-        """Parse output to identify which containers failed"""
-        failed = {}
-        output = stdout + "\n" + stderr
+    def on_guest_migrated(self, vmid: Any, node: Optional[str] = None):
+        """Migration hook: route the guest to its new node from now on"""
+        self.topology.notify_migration(vmid, node)
+        self._audit_log("guest_migrated", None, {"vmid": vmid, "node": node})
+    
+    async def _route_containers(self, job: Dict[str, Any], containers: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Point each container at the node that currently owns it; fail the ones that can't be routed"""
+        routed = []
+        for container in containers:
+            try:
+                location = await self.topology.locate(container["ct_id"])
+            except Exception as e:
+                job["progress"][container["name"]] = "failed"
+                job["results"][container["name"]].update(success=False, error=f"Cannot route container: {e}")
+                continue
+            routed.append(dict(container, **location))
+        return routed
+    
+    async def _patch_containers(self, job: Dict[str, Any], containers: List[Dict[str, Any]]):
+        """Patch LXC containers, in parallel per Proxmox node, with enhanced output parsing
+        
+        Each node's containers are split into shards of container_shard_size,
+        one playbook run each, so no single run's inventory or output grows
+        with the batch. A node's shards share its container limit.
+        """
+        await self._ensure_playbooks_deployed()
+        
+        # Initialize progress for all containers
+        for container in containers:
+            job["progress"][container["name"]] = "running"
+            job["results"][container["name"]] = {"success": False, "output": "", "packages_upgraded": 0}
+        containers = await self._route_containers(job, containers)
         
+        groups = {}
         for container in containers:
-            container_name = container["name"]
-            # Look for failure indicators
-            container_pattern = rf'{re.escape(container_name)}.*?(failed|error|unreachable)'
-            if re.search(container_pattern, output, re.IGNORECASE):
-                error_match = re.search(rf'{re.escape(container_name)}.*?error[:\s]+(.+?)(?:\n|$)', output, re.IGNORECASE)
-                if error_match:
-                    failed[container_name] = error_match.group(1).strip()
-                else:
-                    failed[container_name] = "Execution failed"
+            groups.setdefault(container["node"], []).append(container)
+        forks = self._container_forks(groups, job.get("max_parallel"))
         
-        return failed
+        shards = []
+        for node, group in groups.items():
+            size = max(1, self.container_shard_size)
+            node_shards = [group[start:start + size] for start in range(0, len(group), size)]
+            lanes = min(len(node_shards), forks[node])
+            lane_slots = asyncio.Semaphore(lanes)
+            for index, shard in enumerate(node_shards):
+                phase = f"containers:{node}" if len(node_shards) == 1 else f"containers:{node}:{index}"
+                shard_forks = forks[node] // lanes + (1 if index < forks[node] % lanes else 0)
+                shards.append((shard, self._patch_container_shard(job, phase, shard, shard_forks, lane_slots)))
+        
+        # All shards at once; a run failing as a whole fails only its own containers
+        outcomes = await asyncio.gather(*(run for _, run in shards), return_exceptions=True)
+        for (shard, _), outcome in zip(shards, outcomes):
+            if isinstance(outcome, BaseException):
+                for container in shard:
+                    job["progress"][container["name"]] = "failed"
+                    job["results"][container["name"]].update(success=False, error=str(outcome) or type(outcome).__name__)
+        
+        # pct on the wrong node: the container moved, so re-read placement before any retry
+        if any("does not exist" in (job["results"][container["name"]].get("error") or "") for container in containers):
+            self.topology.invalidate()
     
-    async def _patch_hosts(self, job: Dict[str, Any], host_ips: List[str]):
-        """Patch VMs/physical hosts with enhanced output parsing"""
+    def _container_forks(self, groups: Dict[str, List[Dict[str, Any]]], limit: Optional[int] = None) -> Dict[str, int]:
+        """Containers in flight per node: the node's cap, trimmed to fit the global cap
+        
+        (or the job's own, lower, limit). Every node keeps at least one, so
+        the global cap can't starve a node.
+        """
+        limit = min(limit or self.max_parallel_containers, self.max_parallel_containers)
+        forks = {
+            node: max(1, min(self.node_container_limits.get(node, self.default_node_container_limit), len(group)))
+            for node, group in groups.items()
+        }
+        while sum(forks.values()) > limit and any(f > 1 for f in forks.values()):
+            busiest = max(forks, key=forks.get)
+            forks[busiest] -= 1
+        return forks
+    
+    async def _upload(self, job: Dict[str, Any], path: str, content: str, timeout: float = 30):
+        """Write content to a file on the Ansible machine over stdin
+        
+        Content larger than the transport's stdin limit goes in several
+        appends. The file is written to <path>.part and only moved into
+        place if its sha256 matches, checked in the same call as the last
+        chunk.
+        """
+        transport = self._transport()
+        chunk_size = transport.max_input or len(content) or 1
+        chunks = [content[start:start + chunk_size] for start in range(0, len(content), chunk_size)] or [""]
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        target, part = shlex.quote(path), shlex.quote(path + ".part")
+        
+        for index, chunk in enumerate(chunks):
+            script = f"umask 077 && cat > {part}" if index == 0 else f"cat >> {part}"
+            if index == len(chunks) - 1:
+                script += f" && echo '{digest}  '{part} | sha256sum -c --status && mv {part} {target} && echo OK"
+            result = await self._run_remote(script, job, input=chunk, timeout=timeout)
+            if result.returncode != 0:
+                await self._run_remote(f"rm -f {part}", job, timeout=5)
+                detail = result.stderr.strip() or ("checksum mismatch" if index == len(chunks) - 1 else f"exit code {result.returncode}")
+                raise Exception(f"Failed to upload {path}: {detail}")
+    
+    async def _patch_container_shard(
+        self,
+        job: Dict[str, Any],
+        phase: str,
+        containers: List[Dict[str, Any]],
+        forks: int,
+        lane_slots: asyncio.Semaphore
+    ):
+        """Patch one shard of a node's containers with up to `forks` in flight"""
+        async with lane_slots:
+            container_list_file = "/tmp/ansible_container_list_{}_{}.json".format(job["job_id"], re.sub(r'[^\w.-]', '_', phase))
+            try:
+                await self._upload(job, container_list_file, json.dumps(containers, separators=(",", ":")))
+                
+                # Execute container patching playbook (reads its targets from the list file)
+                playbook_args = [
+                    f"{self.playbook_path}/patch-containers-simple.yml",
+                    "-i", "localhost,",
+                    "--forks", str(forks),
+                    "-e", f"container_list_file={container_list_file}",
+                    "-e", f"patch_type={job['patch_type']}",
+                    "-e", f"dry_run_mode={str(job['dry_run']).lower()}"
+                ]
+                playbook_args += self._apt_cache_args(job, [container["name"] for container in containers])
+                
+                parser = AnsibleOutputParser(
+                    [container["name"] for container in containers],
+                    tasks_total=self._count_playbook_tasks("patch-containers-simple.yml"),
+                    tail_lines=self.output_tail_lines
+                )
+                start_time = time.time()
+                result = await self._stream_playbook(job, phase, playbook_args, parser)
+                elapsed_time = time.time() - start_time
+                
+                self._record_phase_results(job, phase, result, parser, elapsed_time)
+            
+            finally:
+                # Cleanup: Remove container list file from the Ansible machine
+                try:
+                    await self._run_remote(f"rm -f {shlex.quote(container_list_file)}", job, timeout=5)
+                except subprocess.TimeoutExpired:
+                    pass
+    
+    async def _patch_hosts(self, job: Dict[str, Any], host_ips: List[str], forks: Optional[int] = None):
+        """Patch VMs/physical hosts with enhanced output parsing (forks: Ansible's default if None)"""
         # Ensure playbooks are deployed
-        self._ensure_playbooks_deployed()
+        await self._ensure_playbooks_deployed()
         
         # Create host list for Ansible limit
         host_limit = ",".join(host_ips)
         
-        cmd = [
-            "/usr/bin/ssh", "-o", "ConnectTimeout=10", "-o", "BatchMode=yes",
-            self.ansible_host,
-            f"qm guest exec {self.ansible_vm} -- ansible-playbook",
+        playbook_args = [
             f"{self.playbook_path}/patch-debian.yml",
             "-i", "/etc/ansible/hosts",
             "--limit", host_limit,
             "-e", f"patch_type={job['patch_type']}",
             "-e", f"dry_run_mode={str(job['dry_run']).lower()}"
         ]
+        if job.get("max_parallel"):
+            forks = min(forks or job["max_parallel"], job["max_parallel"])
+        if forks:
+            playbook_args += ["--forks", str(forks)]
+        playbook_args += self._apt_cache_args(job, host_ips)
         
         # Initialize progress for all hosts
         for host_ip in host_ips:
             job["progress"][host_ip] = "running"
             job["results"][host_ip] = {"success": False, "output": "", "packages_upgraded": 0}
         
-        start_time = time.time()
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=1800  # 30 minutes
+        parser = AnsibleOutputParser(
+            host_ips,
+            tasks_total=self._count_playbook_tasks("patch-debian.yml"),
+            tail_lines=self.output_tail_lines
         )
-        
+        start_time = time.time()
+        result = await self._stream_playbook(job, "hosts", playbook_args, parser)
         elapsed_time = time.time() - start_time
         
-        # Parse output for progress and package counts
-        parsed_output = self._parse_ansible_output(result.stdout, host_ips)
+        self._record_phase_results(job, "hosts", result, parser, elapsed_time)
+    
+    def _apt_cache_args(self, job: Dict[str, Any], targets: List[str]) -> List[str]:
+        """Extra vars for where apt downloads from and how fresh its state must be
         
-        job["output"].append({
-            "type": "hosts",
+        Dry runs reuse lists up to apt_lists_max_age old. A prefetch always
+        refreshes them, so in a later patch run each prefetched target
+        accepts lists as old as its own prefetch (apt_lists_max_age_by_host):
+        it skips the refresh (which could move candidates past what was
+        downloaded) and installs from the archive cache. Targets that weren't
+        prefetched refresh as usual.
+        """
+        args = ["-e", f"apt_proxy={job['apt_proxy']}"] if job.get("apt_proxy") else []
+        if job.get("prefetch"):
+            return args + ["-e", "prefetch_mode=true", "-e", "apt_lists_max_age=0"]
+        if job["dry_run"]:
+            return args + ["-e", f"apt_lists_max_age={self.apt_lists_max_age}"]
+        now = time.time()
+        ages = {
+            target: int(now - self.prefetched[target]["at"]) + 60 for target in targets
+            if target in self.prefetched and now - self.prefetched[target]["at"] <= self.prefetch_max_age
+        }
+        if ages:
+            args += ["-e", json.dumps({"apt_lists_max_age_by_host": ages})]
+        return args
+    
+    def _record_phase_results(
+        self,
+        job: Dict[str, Any],
+        phase: str,
+        result: subprocess.CompletedProcess,
+        parser: AnsibleOutputParser,
+        elapsed_time: float
+    ):
+        """Store a finished playbook run and the per-target results parsed from it"""
+        job["output"].append(self.jobs.spill_output(job["job_id"], {
+            "type": phase,
             "stdout": result.stdout,
             "stderr": result.stderr,
             "returncode": result.returncode,
-            "parsed": parsed_output,
+            "parsed": {
+                name: {
+                    "packages_available": target["packages_available"],
+                    "packages_upgraded": target["packages_upgraded"],
+                    "security_updates": target["security_updates"],
+                    "status": target["state"],
+                    "stats": target["stats"]
+                }
+                for name, target in parser.targets.items()
+            },
             "elapsed_time": elapsed_time
-        })
+        }))
         
-        # Update progress based on parsed output
-        if result.returncode == 0:
-            for host_ip in host_ips:
-                host_result = parsed_output.get(host_ip, {})
-                job["progress"][host_ip] = "completed"
-                job["results"][host_ip] = {
-                    "success": True,
-                    "output": result.stdout[-1000:] if result.stdout else "",
-                    "packages_upgraded": host_result.get("packages_upgraded", 0),
-                    "security_updates": host_result.get("security_updates", 0)
-                }
-        else:
-            # Parse which hosts failed
-            failed_hosts = self._parse_failed_hosts(result.stdout, result.stderr, host_ips)
-            for host_ip in host_ips:
-                if host_ip in failed_hosts:
-                    job["progress"][host_ip] = "failed"
-                    job["results"][host_ip] = {
-                        "success": False,
-                        "output": result.stderr[-1000:] if result.stderr else "",
-                        "error": failed_hosts[host_ip]
-                    }
-                else:
-                    job["progress"][host_ip] = "completed"
-                    job["results"][host_ip] = {
-                        "success": True,
-                        "output": result.stdout[-1000:] if result.stdout else ""
-                    }
+        for name, target in parser.targets.items():
+            success = target["state"] == "completed"
+            job["progress"][name] = "completed" if success else "failed"
+            host_result = {
+                "success": success,
+                "output": "\n".join(target["lines"]),
+                "packages_available": target["packages_available"],
+                "packages_upgraded": target["packages_upgraded"],
+                "security_updates": target["security_updates"],
+                "packages": target["packages"],
+                "security_packages": target["security_packages"],
+                "upgraded_packages": target["upgraded_packages"],
+                "reboot_required": target["reboot_required"],
+                "fingerprint": target["fingerprint"],
+                "probed": target["probed"],
+                "stats": target["stats"]
+            }
+            if target["staged_bytes"] is not None:
+                host_result["staged_bytes"] = target["staged_bytes"]
+                host_result["cache_bytes"] = target["cache_bytes"]
+            if not success:
+                host_result["error"] = target["error"]
+            job["results"][name] = host_result
+        self._update_inventory(job, list(parser.targets))
+        self._update_prefetched(job, list(parser.targets))
+        self.events.publish(job["job_id"], "results", {
+            "phase": phase,
+            "results": {name: job["results"][name] for name in parser.targets}
+        })
     
-    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
-        """Get job status"""
-        return self.jobs.get(job_id)
+    def get_job(self, job_id: str, include_output: bool = False) -> Optional[Dict[str, Any]]:
+        """Get job status (output blobs only if include_output)"""
+        job = self.jobs.get(job_id)
+        if job is not None and job["status"] == PatchJobStatus.PENDING.value:
+            job = dict(job, queue_position=self.executor.position(job_id))
+        if job is not None and include_output:
+            job = dict(job, output=self.jobs.get_output(job_id))
+        return job
     
-    def list_jobs(self, limit: int = 50) -> List[Dict[str, Any]]:
-        """List all jobs (most recent first)"""
-        jobs = list(self.jobs.values())
-        jobs.sort(key=lambda x: x.get("started_at", ""), reverse=True)
-        return jobs[:limit]
+    def _publish_status(self, job: Dict[str, Any]):
+        """Job store listener: publish a status event when a saved job's status fields changed"""
+        status = {field: job.get(field) for field in self.STATUS_FIELDS if job.get(field) is not None}
+        fingerprint = json.dumps(status, sort_keys=True, default=str)
+        if self._published_status.get(job["job_id"]) == fingerprint:
+            return
+        self.events.publish(job["job_id"], "status", status)
+        if job["status"] in (PatchJobStatus.COMPLETED.value, PatchJobStatus.FAILED.value):
+            self._published_status.pop(job["job_id"], None)
+        else:
+            self._published_status[job["job_id"]] = fingerprint
     
-    def _parse_ansible_output(self, stdout: str, host_ips: List[str]) -> Dict[str, Dict[str, Any]]:
-        """Parse Ansible playbook output to extract progress and package counts"""
-        parsed = {}
+    async def stream_job_events(self, job_id: Optional[str] = None, cursor: Optional[int] = None, keepalive: float = 15):
+        """Server-Sent Events frames of job updates, as deltas
         
-        # Extract package upgrade counts
-        # Pattern: "changed=1 unreachable=0 failed=0"
-        stats_pattern = r'changed=(\d+).*?unreachable=(\d+).*?failed=(\d+)'
+        Without a cursor a job's stream opens with a "snapshot" of the job
+        (no output blobs); after that only status/progress/output/results/
+        audit events follow. Each frame's id is its cursor: pass the last one
+        seen (Last-Event-ID) to resume. Serve it with a text/event-stream
+        StreamingResponse; a WebSocket handler can iterate
+        self.events.subscribe() directly instead.
+        """
+        if cursor is None and job_id is not None:
+            cursor = self.events.last_seq
+            job = self.get_job(job_id)
+            if job is not None:
+                yield f"id: {cursor}\nevent: snapshot\ndata: {json.dumps(job, default=str)}\n\n"
+        async for event in self.events.subscribe(job_id, cursor, keepalive=keepalive):
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+    
+    def cancel_job(self, job_id: str) -> bool:
+        """Cancel a job that is scheduled or still queued
         
-        # Extract per-host results
-        for host_ip in host_ips:
-            host_data = {
-                "packages_upgraded": 0,
-                "security_updates": 0,
-                "status": "unknown"
-            }
-            
-            # Look for host-specific output
-            host_lines = [line for line in stdout.split('\n') if host_ip in line]
-            
-            # Try to extract package counts
-            for line in host_lines:
-                if 'upgraded' in line.lower() or 'packages' in line.lower():
-                    # Extract numbers
-                    numbers = re.findall(r'\d+', line)
-                    if numbers:
-                        host_data["packages_upgraded"] = int(numbers[0])
-            
-            parsed[host_ip] = host_data
+        Cancelling a scheduled recurring job ends the series (the next
+        occurrence is only created at dispatch) and cancels its prefetch, if
+        it has one that hasn't started. Running jobs, and jobs
+        queued as part of a merged run, can't be cancelled; returns False.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        if job["status"] == PatchJobStatus.SCHEDULED.value:
+            self.scheduler.cancel(job_id)
+        elif job["status"] != PatchJobStatus.PENDING.value or job.get("merged_group") or not self.executor.cancel(job_id):
+            return False
+        job["status"] = PatchJobStatus.CANCELLED.value
+        job["completed_at"] = datetime.now().isoformat()
+        self.jobs.finish(job)
+        self._audit_log("job_cancelled", job_id, {"hosts": job["hosts"]})
+        if job.get("prefetch_job_id"):
+            self.cancel_job(job["prefetch_job_id"])  # nothing left to stage for
+        return True
+    
+    def get_queue_status(self) -> Dict[str, Any]:
+        """Job queue depth, running jobs and per-node load"""
+        return self.executor.depth()
+    
+    def list_jobs(self, limit: int = 50, offset: int = 0, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        """List jobs (most recent first), paged and optionally filtered by status"""
+        return self.jobs.list(limit=limit, offset=offset, status=status)
+    
+    def _load_error_config(self, path: Optional[str]):
+        """Load classifier rules and retry policies from a JSON file
         
-        return parsed
+        {"rules": [{"category": "lock", "pattern": "..."}, ...],
+         "retry_policies": {"network": {"max_attempts": 5, ...}, ...}}
+        Rules replace the built-in list (keep their priority order);
+        retry policies are merged over the defaults per category.
+        """
+        if not path:
+            return
+        with open(path) as f:
+            config = json.load(f)
+        if config.get("rules"):
+            self.error_classifier = ErrorClassifier(config["rules"])
+        for category, policy in config.get("retry_policies", {}).items():
+            ErrorCategory(category)  # reject typos at startup
+            self.retry_policies[category] = dict(self.retry_policies.get(category, {}), **policy)
     
-    def _parse_failed_hosts(self, stdout: str, stderr: str, host_ips: List[str]) -> Dict[str, str]:
-        """Parse output to identify which hosts failed"""
-        failed = {}
-        output = stdout + "\n" + stderr
+    def benchmark_classifier(self, hosts: int = 200, stderr_bytes: int = 256 * 1024, rounds: int = 3) -> Dict[str, Any]:
+        """Time classification of large synthetic stderr captures
         
-        for host_ip in host_ips:
-            # Look for failure indicators for this host
-            host_pattern = rf'{re.escape(host_ip)}.*?(failed|unreachable|error)'
-            if re.search(host_pattern, output, re.IGNORECASE):
-                # Extract error message
-                error_match = re.search(rf'{re.escape(host_ip)}.*?error[:\s]+(.+?)(?:\n|$)', output, re.IGNORECASE)
-                if error_match:
-                    failed[host_ip] = error_match.group(1).strip()
-                else:
-                    failed[host_ip] = "Execution failed"
+        Compares the classifier with a single case-insensitive alternation of
+        the same rules, scanned once over all hosts' text.
+        """
+        filler = "Reading package lists... Building dependency tree... Reading state information...\n"
+        tails = [
+            "E: Could not get lock /var/lib/dpkg/lock-frontend",
+            "ssh: connect to host 10.0.0.1 port 22: Connection timed out",
+            "E: Unmet dependencies. Try 'apt --fix-broken install'",
+            "Permission denied (publickey).",
+            "Timeout (12s) waiting for privilege escalation prompt: ",
+            "something unexpected happened"
+        ]
+        texts = {
+            f"host{index}": filler * (stderr_bytes // len(filler)) + tails[index % len(tails)]
+            for index in range(hosts)
+        }
+        rules = self.error_classifier.rules
+        alternation = re.compile(
+            "|".join(f"(?P<r{index}>{pattern.pattern})" for index, (_, pattern) in enumerate(rules)),
+            re.IGNORECASE | re.MULTILINE
+        )
         
-        return failed
-    
-    def _categorize_error(self, error_msg: str) -> ErrorCategory:
-        """Categorize error for retry logic"""
-        error_lower = error_msg.lower()
-        
-        if any(term in error_lower for term in ['timeout', 'timed out', 'connection']):
-            return ErrorCategory.NETWORK
-        elif any(term in error_lower for term in ['permission', 'denied', 'unauthorized', 'forbidden']):
-            return ErrorCategory.PERMISSION
-        elif any(term in error_lower for term in ['package', 'apt', 'dpkg', 'dependency']):
-            return ErrorCategory.PACKAGE
-        elif 'timeout' in error_lower:
-            return ErrorCategory.TIMEOUT
-        else:
-            return ErrorCategory.UNKNOWN
+        def single_alternation():
+            names = list(texts)
+            offsets = list(itertools.accumulate((len(texts[name]) + 1 for name in names[:-1]), initial=0))
+            best = {}
+            for match in alternation.finditer("\n".join(texts.values())):
+                name = names[bisect.bisect_right(offsets, match.start()) - 1]
+                best[name] = min(best.get(name, len(rules)), int(match.lastgroup[1:]))
+            return {name: rules[best[name]][0] if name in best else ErrorCategory.UNKNOWN for name in names}
+        
+        total = sum(map(len, texts.values()))
+        timings = {}
+        for label, run in (("classifier", lambda: self.error_classifier.classify_all(texts)), ("single_alternation", single_alternation)):
+            best = None
+            for _ in range(rounds):
+                start = time.perf_counter()
+                categories = run()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[label] = {
+                "seconds": round(best, 4),
+                "mib_per_second": round(total / best / 2**20, 1),
+                "categories": {category.value: list(categories.values()).count(category) for category in ErrorCategory}
+            }
+        return {"hosts": hosts, "stderr_bytes": stderr_bytes, **timings}
     
     def _audit_log(self, action: str, job_id: str, details: Dict[str, Any]):
         """Log audit events"""
@@ -789,11 +2960,15 @@ fi
             "details": details
         }
         self.audit_log.append(log_entry)
-        
-        # Keep only last 1000 entries
-        if len(self.audit_log) > 1000:
-            self.audit_log = self.audit_log[-1000:]
+        self.events.publish(job_id, "audit", log_entry)
     
-    def get_audit_log(self, limit: int = 100) -> List[Dict[str, Any]]:
-        """Get audit log entries"""
-        return self.audit_log[-limit:]
+    def get_audit_log(
+        self,
+        limit: int = 100,
+        job_id: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Get audit log entries, optionally filtered by job, action and time range"""
+        return self.audit_log.query(limit=limit, job_id=job_id, action=action, since=since, until=until)